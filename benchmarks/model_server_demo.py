@@ -0,0 +1,79 @@
+import argparse
+import os
+import tempfile
+import time
+
+import tracing
+from benchmarks.pipeline_replay import synthetic_corpus
+from benchmarks.stubs import StubASR, StubLLM, StubTTS
+from messaging import MessageType
+from modules.basic_modules import BasicBroker, BasicProxy
+from modules.model_registry import ModelRegistry
+from modules.model_server import ModelClient, ModelServer
+from modules.module import Module
+from modules.replay_modules import CaptureSink, FileInputDevice
+
+
+def build_session(address: str, session: str, priority: int, paths: list[str], speed: float) -> tuple[ModelClient, FileInputDevice, list[Module]]:
+    # the pipeline of one channel, its models are those of the server with a voice of its own
+    client = ModelClient(address, session, options={"kokoro": {"voice": f"{session}_voice"}})
+    input_device = FileInputDevice(f"{session}_input", paths, speed=speed)
+    parakeet_converter = BasicProxy(f"{session}_parakeet", client["parakeet"].transform("transcribe", priority=priority), priority=priority)
+    phi4_broker = BasicBroker(f"{session}_phi4", priority=priority)
+    kokoro_converter = BasicProxy(f"{session}_kokoro", client["kokoro"].transform("transcribe", priority=priority), priority=priority)
+    output_device = CaptureSink(f"{session}_output", speed=speed, on_first_audio=input_device.replied)
+
+    input_device.register_sink(parakeet_converter, MessageType.AUDIO)
+    parakeet_converter.register_sink(phi4_broker, MessageType.TEXT)
+    phi4_broker.register_route(parakeet_converter, kokoro_converter, client["phi4"].transform("process_host", priority=priority))
+    kokoro_converter.register_sink(output_device, MessageType.TEXT)
+    kokoro_converter.register_sink(output_device, MessageType.AUDIO)
+    return client, input_device, [output_device, kokoro_converter, phi4_broker, parakeet_converter, input_device]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="several pipelines sharing one set of stub models through a model server on localhost")
+    parser.add_argument("--sessions", type=int, default=3)
+    parser.add_argument("--synthetic", type=int, default=4, help="number of synthetic utterances replayed by each session")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed, 0 to send the utterances as fast as possible")
+    parser.add_argument("--priorities", type=int, nargs="+", help="priority of each session, the first one has the highest by default")
+    args = parser.parse_args()
+
+    exporter = tracing.InProcessExporter()
+    tracing.metrics.add_exporter(exporter)
+    priorities = args.priorities or list(range(args.sessions))
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = synthetic_corpus(directory, args.synthetic)
+        registry = ModelRegistry(compile_cache_dir=None)
+        registry.register("parakeet", StubASR)
+        registry.register("phi4", StubLLM)
+        registry.register("kokoro", StubTTS)
+        server = ModelServer(os.path.join(directory, "models.sock"), registry)
+        server.start()
+
+        sessions = [build_session(server.address, f"channel_{i}", priorities[i], paths, args.speed) for i in range(args.sessions)]
+        start = time.perf_counter()
+        for client, _, nodes in sessions:
+            client.start()
+            for node in nodes:
+                node.start()
+        try:
+            for _, input_device, _ in sessions:
+                input_device.done.wait()
+        except KeyboardInterrupt:
+            pass
+        wall = time.perf_counter() - start
+
+        print(server.report())
+        for client, _, nodes in sessions:
+            for node in reversed(nodes):
+                node.stop()
+            client.stop()
+        server.stop()
+
+    print(f"{'series':<80} {'count':>6} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9}")
+    for series, summary in exporter.summary().items():
+        if series.startswith(("end_of_speech_to_first_audio_seconds", "model_server_")):
+            print(f"{series:<80} {summary['count']:>6} {summary['p50'] * 1000:>9.1f} {summary['p95'] * 1000:>9.1f} {summary['p99'] * 1000:>9.1f}")
+    print(f"wall {wall:.2f}s for {args.sessions} sessions of {len(paths)} utterances")
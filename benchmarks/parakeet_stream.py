@@ -0,0 +1,80 @@
+import argparse
+import time
+
+import numpy as np
+from messaging import MessageType
+from models.asr.parakeet import Parakeet
+from modules.audio_utils import read_wav
+
+SAMPLERATE = 16000
+
+
+def counted(asr: Parakeet) -> dict[str, float]:
+    # counts the decodes of the model and the audio they go through
+    counts = {"decodes": 0, "decoded": 0.0, "longest": 0.0}
+    transcribe = asr.model.transcribe
+
+    def wrapper(audio, *args, **kwargs):
+        counts["decodes"] += 1
+        counts["decoded"] += len(audio[0]) / SAMPLERATE
+        counts["longest"] = max(counts["longest"], len(audio[0]) / SAMPLERATE)
+        return transcribe(audio, *args, **kwargs)
+
+    asr.model.transcribe = wrapper
+    return counts
+
+
+def replay(asr: Parakeet, audio: np.ndarray, chunk: float, batched: bool) -> tuple[str, float]:
+    # the chunks are recorded in real time, with `batched` those that arrived while the previous decode ran are decoded together
+    size = int(chunk * SAMPLERATE)
+    chunks = [(audio[i : i + size], SAMPLERATE, i + size >= len(audio), "replay") for i in range(0, len(audio), size)]
+    start = time.perf_counter()
+    transcription = ""
+    sent = 0
+    while sent < len(chunks):
+        time.sleep(max((sent + 1) * chunk - (time.perf_counter() - start), 0.0))
+        if batched:
+            arrived = min(max(int((time.perf_counter() - start) / chunk), sent + 1), len(chunks))
+            batch = [(MessageType.AUDIO, content) for content in chunks[sent:arrived]]
+            outputs = [(type, content) for _, type, content in asr.transcribe_stream_batch(batch)]
+        else:
+            arrived = sent + 1
+            outputs = list(asr.transcribe_stream(MessageType.AUDIO, chunks[sent]))
+        transcription = next((content for type, content in outputs if type == MessageType.TEXT), transcription)
+        sent = arrived
+    return transcription, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="count the decodes of the streaming transcription of one long utterance")
+    parser.add_argument("paths", nargs="+", help="recordings concatenated into one utterance")
+    parser.add_argument("--min-duration", type=float, default=12.0, help="the recordings are repeated up to this duration in seconds")
+    parser.add_argument("--chunk", type=float, default=0.5, help="duration of the chunks sent by the input device")
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    audio = np.concatenate([read_wav(path, SAMPLERATE)[0] for path in args.paths])
+    audio = np.tile(audio, int(np.ceil(args.min_duration * SAMPLERATE / len(audio))))
+    duration = len(audio) / SAMPLERATE
+    chunks = int(np.ceil(len(audio) / (args.chunk * SAMPLERATE)))
+
+    asr = Parakeet(device=args.device)
+    asr.warmup()
+    counts = counted(asr)
+
+    print(f"{duration:.1f}s of audio in {chunks} chunks of {args.chunk}s, stream window of {asr.stream_window}s")
+    print(f"{'mode':<10} {'decodes':>8} {'decoded (s)':>12} {'longest (s)':>12} {'decoded/audio':>14} {'wall (s)':>9}")
+    transcriptions = {}
+    for mode in ("per_chunk", "batched"):
+        counts.update(decodes=0, decoded=0.0, longest=0.0)
+        transcriptions[mode], wall = replay(asr, audio, args.chunk, batched=mode == "batched")
+        print(
+            f"{mode:<10} {counts['decodes']:>8} {counts['decoded']:>12.1f} {counts['longest']:>12.1f}"
+            f" {counts['decoded'] / duration:>14.2f} {wall:>9.2f}"
+        )
+        # a decode per chunk at most, and the committed prefix is not decoded again
+        assert counts["decodes"] <= chunks, f"{counts['decodes']} decodes for {chunks} chunks"
+        if mode == "per_chunk":
+            assert counts["longest"] <= asr.stream_window + args.chunk, f"a decode went through {counts['longest']:.1f}s of audio"
+    for mode, transcription in transcriptions.items():
+        print(f"({mode})", transcription)
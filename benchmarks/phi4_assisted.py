@@ -0,0 +1,50 @@
+import argparse
+import time
+
+from models.llm.phi4 import Phi4
+
+HISTORY = (
+    ("user", "Salut ! Ce soir on parle de la rénovation de ma cuisine, j'ai enfin reçu le devis du menuisier."),
+    ("assistant", "Super ! Qu'est-ce qu'il propose pour les façades et le plan de travail ?"),
+    ("user", "Des façades en chêne massif et un plan de travail en quartz blanc, pour un total de huit mille euros."),
+    ("assistant", "Le chêne massif et le quartz blanc vont bien ensemble. Huit mille euros, c'est dans la moyenne pour ce type de finition."),
+    ("user", "Oui, mais il faut encore ajouter l'électroménager, je pensais à une plaque à induction et un four à chaleur tournante."),
+    ("assistant", "Une plaque à induction et un four à chaleur tournante, c'est un bon choix. Compte environ mille cinq cents euros de plus."),
+    ("user", "Et les travaux devraient commencer en mars, si le menuisier tient ses délais."),
+)
+
+
+def measure(llm: Phi4, prompt_lookup_num_tokens: int | None, max_new_tokens: int) -> tuple[str, float, float, float]:
+    llm.prompt_lookup_num_tokens = prompt_lookup_num_tokens
+    summary = [{"role": "system", "content": llm.system_prompt_summary}] + [{"role": role, "content": content} for role, content in HISTORY]
+    inputs = llm.tokenizer.apply_chat_template(summary, add_generation_prompt=True, return_dict=True, return_tensors="pt").to(llm.model.device)
+    start = time.perf_counter()
+    # greedy, so that the outputs with and without drafts have to be identical
+    text = "".join(llm.stream(inputs, "Summurizing", max_new_tokens, do_sample=False, **llm.assisted_decoding()))
+    return text, time.perf_counter() - start, llm.tokens_per_forward, llm.acceptance_rate
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compare summarization with and without prompt-lookup decoding")
+    parser.add_argument("--model", default="microsoft/Phi-4-mini-instruct")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--max-new-tokens", type=int, default=256)
+    parser.add_argument("--prompt-lookup", type=int, nargs="+", default=[3, 5, 10], help="numbers of drafted tokens to try")
+    args = parser.parse_args()
+
+    llm = Phi4(
+        model_path=args.model,
+        system_prompt_summary="Résume la conversation suivante de manière concise en conservant les détails importants.",
+        device=args.device,
+        reuse_cache=False,
+    )
+    # the first run also warms up the compiled model
+    measure(llm, None, 8)
+    reference, baseline, _, _ = measure(llm, None, args.max_new_tokens)
+
+    print(f"{'drafted':>8} {'time (s)':>9} {'speedup':>8} {'tokens/forward':>15} {'acceptance':>11} {'identical':>10}")
+    print(f"{'-':>8} {baseline:>9.2f} {1:>8.2f} {1:>15.2f} {'-':>11} {'yes':>10}")
+    for num_tokens in args.prompt_lookup:
+        text, elapsed, tokens_per_forward, acceptance_rate = measure(llm, num_tokens, args.max_new_tokens)
+        identical = "yes" if text == reference else "no"
+        print(f"{num_tokens:>8} {elapsed:>9.2f} {baseline / elapsed:>8.2f} {tokens_per_forward:>15.2f} {acceptance_rate:>11.1%} {identical:>10}")
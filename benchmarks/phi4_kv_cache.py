@@ -0,0 +1,46 @@
+import argparse
+import time
+
+from messaging import MessageType
+from models.llm.phi4 import Phi4
+
+TURNS = (1, 20, 100)
+
+
+def run(llm: Phi4, reuse_cache: bool, turns: int) -> dict[int, tuple[float, float]]:
+    llm.reuse_cache = reuse_cache
+    llm.reset_host()
+
+    results = {}
+    for turn in range(1, turns + 1):
+        start = time.perf_counter()
+        for _ in llm.process_host(MessageType.TEXT, f"Message numéro {turn}, peux-tu me donner une anecdote courte sur le nombre {turn} ?"):
+            pass
+        if turn in TURNS:
+            results[turn] = (llm.ttft, time.perf_counter() - start)
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compare time-to-first-token with and without KV cache reuse across turns")
+    parser.add_argument("--model", default="microsoft/Phi-4-mini-instruct")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--temperature", type=float, default=0.0, help="0 decodes greedily, both runs then reply the same")
+    args = parser.parse_args()
+
+    llm = Phi4(
+        model_path=args.model,
+        system_prompt_host="Tu es un assistant concis.",
+        max_new_tokens=args.max_new_tokens,
+        context_size_limit=1 << 20,
+        device=args.device,
+        temperature=args.temperature,
+    )
+    cold = run(llm, False, max(TURNS))
+    warm = run(llm, True, max(TURNS))
+
+    print(f"{'turn':>6} {'ttft cold (s)':>14} {'ttft cached (s)':>16} {'turn cold (s)':>14} {'turn cached (s)':>16}")
+    for turn in TURNS:
+        print(f"{turn:>6} {cold[turn][0]:>14.3f} {warm[turn][0]:>16.3f} {cold[turn][1]:>14.3f} {warm[turn][1]:>16.3f}")
@@ -0,0 +1,94 @@
+import argparse
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+import psutil
+import torch
+from models.llm.phi4 import QUANTIZATIONS, Phi4
+
+PROMPTS = (
+    "Explique en trois phrases pourquoi le ciel est bleu.",
+    "Quelle est la capitale de l'Australie et pourquoi n'est-ce pas Sydney ?",
+    "Donne-moi une recette simple de crêpes.",
+    "Résume l'intrigue du Petit Prince en quelques lignes.",
+    "Quels sont les avantages et les inconvénients du télétravail ?",
+    "Write a haiku about autumn rain.",
+    "Combien font 17 fois 23 ? Détaille le calcul.",
+    "Cite trois instruments de musique à cordes et décris leur son.",
+)
+
+
+def measure(model_path: str, device: str, quantization: str | None, max_new_tokens: int, references: list[list[int]] | None) -> dict:
+    # runs in a fresh process so that the memory of one mode is not mixed with the previous one
+    process = psutil.Process()
+    rss = process.memory_info().rss
+    llm = Phi4(model_path=model_path, max_new_tokens=max_new_tokens, device=device, reuse_cache=False, quantization=quantization)
+    footprint = process.memory_info().rss - rss
+
+    prompt_tokens = 0
+    prefill = 0.0
+    decode = []
+    outputs = []
+    nll = 0.0
+    scored = 0
+    agreement = []
+    for i, prompt in enumerate(PROMPTS):
+        inputs = llm.tokenizer.apply_chat_template(
+            [{"role": "user", "content": prompt}], add_generation_prompt=True, return_dict=True, return_tensors="pt"
+        ).to(llm.model.device)
+        for _ in llm.stream(inputs, "Measuring", max_new_tokens, do_sample=False):
+            pass
+        prompt_tokens += inputs["input_ids"].shape[1]
+        prefill += llm.ttft
+        decode.append(llm.tokens_per_second)
+
+        # greedy decoding again, outside of the streamer, to get the token ids
+        with torch.inference_mode():
+            out = llm.model.generate(**inputs, generation_config=llm.generation_config, max_new_tokens=max_new_tokens, do_sample=False)
+        output = out[0, inputs["input_ids"].shape[1] :].tolist()
+        outputs.append(output)
+
+        # perplexity of the bf16 answer under this model, and how many of its tokens are reproduced at the same position,
+        # without references the model is scored on its own answers
+        expected = references[i] if references is not None else output
+        if expected:
+            reference = torch.tensor([expected], device=llm.model.device)
+            ids = torch.cat([inputs["input_ids"], reference], dim=1)
+            with torch.inference_mode():
+                logits = llm.model(input_ids=ids).logits[0, inputs["input_ids"].shape[1] - 1 : -1].float()
+            nll += torch.nn.functional.cross_entropy(logits, reference[0], reduction="sum").item()
+            scored += reference.shape[1]
+            agreement.append(sum(a == b for a, b in zip(output, expected)) / len(expected))
+
+    return {
+        "outputs": outputs,
+        "footprint": footprint,
+        "prefill": prompt_tokens / prefill,
+        "decode": sum(decode) / len(decode),
+        "perplexity": float(torch.tensor(nll / scored).exp()) if scored else float("nan"),
+        "agreement": sum(agreement) / len(agreement) if agreement else 1.0,
+    }
+
+
+def run(model_path: str, device: str, quantization: str | None, max_new_tokens: int, references: list[list[int]] | None) -> dict:
+    with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context("spawn")) as executor:
+        return executor.submit(measure, model_path, device, quantization, max_new_tokens, references).result()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compare the speed, memory and quality of the quantization modes of Phi4 against bf16")
+    parser.add_argument("--model", default="microsoft/Phi-4-mini-instruct")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--modes", nargs="+", choices=QUANTIZATIONS, default=list(QUANTIZATIONS))
+    args = parser.parse_args()
+
+    baseline = run(args.model, args.device, None, args.max_new_tokens, None)
+    results = {"bf16": baseline} | {mode: run(args.model, args.device, mode, args.max_new_tokens, baseline["outputs"]) for mode in args.modes}
+
+    print(f"{'mode':<18} {'memory (MiB)':>13} {'prefill (tok/s)':>16} {'decode (tok/s)':>15} {'perplexity':>11} {'agreement':>10}")
+    for mode, result in results.items():
+        print(
+            f"{mode:<18} {result['footprint'] / 2**20:>13.0f} {result['prefill']:>16.1f} {result['decode']:>15.1f}"
+            f" {result['perplexity']:>11.3f} {result['agreement']:>10.1%}"
+        )
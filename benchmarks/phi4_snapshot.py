@@ -0,0 +1,98 @@
+import argparse
+import math
+import os
+import tempfile
+import threading
+import time
+
+from messaging import MessageType
+from models.llm.phi4 import Phi4
+
+SIZES = (1000, 4000, 16000)
+QUESTION = "Peux-tu me rappeler en une phrase de quoi nous avons parlé ?"
+
+
+def fill(llm: Phi4, size: int) -> None:
+    # a synthetic conversation of about `size` tokens
+    llm.reset_host()
+    turn = 0
+    while llm.history_host_size < size:
+        turn += 1
+        llm.append_host("user", f"Message numéro {turn} : raconte-moi une anecdote sur le nombre {turn} et sur ce qu'il évoque pour toi.")
+        llm.append_host("assistant", f"Le nombre {turn} fait penser à beaucoup de choses, par exemple à la page {turn} d'un vieux livre oublié.")
+
+
+def ttft(llm: Phi4) -> float:
+    for _ in llm.process_host(MessageType.TEXT, QUESTION):
+        pass
+    return llm.ttft
+
+
+def measure(llm: Phi4, path: str, size: int) -> dict[str, float]:
+    fill(llm, size)
+    history, tokens = list(llm.history_host), list(llm.history_host_tokens)
+
+    start = time.perf_counter()
+    llm.cache, llm.cache_ids = llm.prefill(history, threading.Event())
+    prefill = time.perf_counter() - start
+
+    # what the generation pays is the capture of the state, the write happens in the background
+    start = time.perf_counter()
+    llm.save_snapshot(force=True)
+    capture = time.perf_counter() - start
+    llm.snapshots.flush()
+    write = time.perf_counter() - start
+
+    llm.cache = llm.cache_ids = None
+    start = time.perf_counter()
+    llm.restore(path)
+    restore = time.perf_counter() - start
+    restored = ttft(llm)
+
+    llm.replace_host(list(history), list(tokens))
+    llm.cache = llm.cache_ids = None
+    cold = ttft(llm)
+
+    return {
+        "tokens": sum(tokens),
+        "prefill": prefill,
+        "capture": capture,
+        "write": write,
+        "size": os.path.getsize(path) / 2**20,
+        "restore": restore,
+        "ttft_restored": restored,
+        "ttft_cold": cold,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compare resuming a conversation from a snapshot with prefilling its history again")
+    parser.add_argument("--model", default="microsoft/Phi-4-mini-instruct")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--max-new-tokens", type=int, default=16)
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "session.pt")
+        # only the snapshots asked for by the benchmark are written
+        llm = Phi4(
+            model_path=args.model,
+            system_prompt_host="Tu es un assistant concis.",
+            max_new_tokens=args.max_new_tokens,
+            context_size_limit=1 << 20,
+            device=args.device,
+            snapshot_path=path,
+            snapshot_interval=math.inf,
+        )
+        results = [measure(llm, path, size) for size in args.sizes]
+
+    print(
+        f"{'tokens':>7} {'prefill (s)':>12} {'capture (ms)':>13} {'write (s)':>10} {'size (MiB)':>11} {'restore (s)':>12}"
+        f" {'ttft restored (s)':>18} {'ttft cold (s)':>14}"
+    )
+    for result in results:
+        print(
+            f"{result['tokens']:>7} {result['prefill']:>12.2f} {result['capture'] * 1000:>13.1f} {result['write']:>10.2f} {result['size']:>11.1f}"
+            f" {result['restore']:>12.3f} {result['ttft_restored']:>18.3f} {result['ttft_cold']:>14.3f}"
+        )
@@ -0,0 +1,199 @@
+import argparse
+import functools
+import os
+import resource
+import tempfile
+import time
+
+import numpy as np
+import tracing
+from benchmarks.stubs import StubASR, StubLLM, StubTTS
+from messaging import MessageType, QueuePolicy
+from modules.audio_utils import write_wav
+from modules.basic_modules import BasicBroker, BasicProxy, BatchProxy
+from modules.chat_modules import ChatFeed
+from modules.process_module import ProcessModule
+from modules.replay_modules import CaptureSink, FileInputDevice
+
+
+COUNTS = (
+    "sink_queue_depth",
+    "sink_queue_drops",
+    "sink_queue_high_water",
+    "broker_route_drops",
+    "llm_chat_dropped",
+    "batch_size",
+    "llm_chat_batch_size",
+    "tts_real_time_factor",
+    "llm_tokens_per_second",
+)
+
+
+def synthetic_corpus(directory: str, count: int, samplerate: int = 16000) -> list[str]:
+    # speech-like noise bursts of various durations, for when no recorded corpus is at hand
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(count):
+        duration = rng.uniform(1.0, 4.0)
+        t = np.arange(int(duration * samplerate)) / samplerate
+        audio = 0.1 * rng.standard_normal(len(t)) * (0.6 + 0.4 * np.sin(2 * np.pi * 4 * t))
+        path = os.path.join(directory, f"utterance_{i}.wav")
+        write_wav(path, audio.astype(np.float32), samplerate)
+        paths.append(path)
+    return paths
+
+
+def build_models(real: bool) -> tuple[ProcessModule, ProcessModule, ProcessModule]:
+    if real:
+        from models.asr.parakeet import Parakeet
+        from models.llm.phi4 import Phi4
+        from models.tts.kokoro82M import Kokoro82M
+
+        with open("assistant/system_prompt.txt") as f:
+            llm_factory = functools.partial(Phi4, system_prompt_host=f.read(), max_new_tokens=512, context_size_limit=16384, device="cpu")
+        asr = ProcessModule("parakeet", Parakeet, num_threads=2, num_interop_threads=1)
+        llm = ProcessModule("phi4", llm_factory, num_threads=4, num_interop_threads=2)
+        tts = ProcessModule("kokoro", functools.partial(Kokoro82M, voice="ff_siwis"), num_threads=2, num_interop_threads=1)
+    else:
+        asr = ProcessModule("parakeet", StubASR)
+        llm = ProcessModule("phi4", StubLLM)
+        tts = ProcessModule("kokoro", StubTTS)
+    return asr, llm, tts
+
+
+def report(exporter: tracing.InProcessExporter, wall: float, start_usage: resource.struct_rusage) -> None:
+    print(f"{'series':<80} {'count':>6} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9}")
+    for series, summary in exporter.summary().items():
+        # ratios, rates and counts are not durations
+        scale = 1 if series.startswith(COUNTS) else 1000
+        print(f"{series:<80} {summary['count']:>6} {summary['p50'] * scale:>9.1f} {summary['p95'] * scale:>9.1f} {summary['p99'] * scale:>9.1f}")
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = usage.ru_utime + usage.ru_stime - start_usage.ru_utime - start_usage.ru_stime
+    cpu_children = children.ru_utime + children.ru_stime
+    # ru_maxrss is in kilobytes on linux, for the children it is the largest of them
+    print(f"wall {wall:.2f}s, cpu {cpu:.2f}s (+{cpu_children:.2f}s in model processes)")
+    print(f"peak rss {usage.ru_maxrss / 1024:.0f} MiB (largest model process {children.ru_maxrss / 1024:.0f} MiB)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="replay recorded utterances through the pipeline and report latencies and resource usage")
+    parser.add_argument("paths", nargs="*", help="wav files, one utterance each, synthetic ones are generated if none are given")
+    parser.add_argument("--synthetic", type=int, default=5, help="number of synthetic utterances")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed, 0 to send the utterances as fast as possible")
+    parser.add_argument("--endpoint-delay", type=float, default=1.0, help="silence before the end of an utterance is detected")
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument("--real-models", action="store_true", help="use Parakeet, Phi4 and Kokoro instead of the stubs")
+    parser.add_argument("--capture", help="write the synthesized speech to this wav file")
+    parser.add_argument("--guests", type=int, default=0, help="other speakers replaying the corpus at the same time, their utterances are batched with the host's")
+    parser.add_argument("--chat", help="file of \"user: comment\" lines replayed as the chat of the stream")
+    parser.add_argument("--chat-rate", type=float, default=2.0, help="comments per second")
+    parser.add_argument("--chat-batch-size", type=int, default=8)
+    parser.add_argument("--chat-backlog", type=int, default=32, help="comments waiting to be answered, the oldest are dropped beyond")
+    args = parser.parse_args()
+
+    exporter = tracing.InProcessExporter()
+    tracing.metrics.add_exporter(exporter)
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = args.paths or synthetic_corpus(directory, args.synthetic)
+        input_device = FileInputDevice("input_device", paths, speed=args.speed, endpoint_delay=args.endpoint_delay, streaming=args.streaming)
+        guests = [
+            FileInputDevice(
+                f"guest_{i}",
+                paths,
+                speed=args.speed,
+                endpoint_delay=args.endpoint_delay,
+                gap_duration=i + 1,
+                streaming=args.streaming,
+                wait_for_reply=False,
+            )
+            for i in range(args.guests)
+        ]
+
+    asr, llm, tts = build_models(args.real_models)
+    asr.start()
+    llm.start()
+    tts.start()
+    for model in (asr, llm, tts):
+        model.ready.wait()
+
+    phi4_broker = BasicBroker("phi4_broker")
+    kokoro_converter = BasicProxy("kokoro_converter", tts.transform("transcribe"))
+    if guests:
+        # the utterances of every speaker are transcribed together, the transcripts keep their origin for the broker,
+        # streamed chunks are decoded per speaker
+        parakeet_converter = (
+            BatchProxy("parakeet_converter", asr.batch_transform("transcribe_stream_batch"), max_batch_size=64, max_wait=0.0, per_producer=True)
+            if args.streaming
+            else BatchProxy("parakeet_converter", asr.batch_transform("transcribe_batch"), max_wait=0.1, per_producer=True)
+        )
+        for device in [input_device, *guests]:
+            device.register_sink(parakeet_converter, MessageType.AUDIO)
+            phi4_broker.register_route(parakeet_converter.producer_for(device), kokoro_converter, llm.transform("process_host"))
+    elif args.streaming:
+        # the chunks queued while the previous ones are decoded are decoded together
+        parakeet_converter = BatchProxy("parakeet_converter", asr.batch_transform("transcribe_stream_batch"), max_batch_size=64, max_wait=0.0)
+        input_device.register_sink(parakeet_converter, MessageType.AUDIO)
+        phi4_broker.register_route(parakeet_converter, kokoro_converter, llm.transform("process_host"))
+    else:
+        parakeet_converter = BasicProxy("parakeet_converter", asr.transform("transcribe"))
+        input_device.register_sink(parakeet_converter, MessageType.AUDIO)
+        phi4_broker.register_route(parakeet_converter, kokoro_converter, llm.transform("process_host"))
+    parakeet_converter.register_sink(phi4_broker, MessageType.TEXT)
+
+    if args.chat:
+        # chat replies go through the same speech synthesis, behind the replies to the host
+        chat_feed = ChatFeed.from_file("chat_feed", args.chat, rate=args.chat_rate * max(args.speed, 1), loop=True)
+        chat_converter = BatchProxy("chat_converter", llm.batch_transform("process_chat_batch"), max_batch_size=args.chat_batch_size, priority=1)
+        chat_converter.set_queue_capacity(args.chat_backlog, QueuePolicy.DROP_OLDEST)
+        chat_feed.register_sink(chat_converter, MessageType.TEXT)
+        chat_converter.register_sink(kokoro_converter, MessageType.TEXT)
+        # the host transcript stops the chat batch on the controls channel, without waiting behind it in the model process
+        phi4_broker.register_preempt(llm.method("preempt_chat"))
+
+    output_device = CaptureSink("output_device", speed=args.speed, capture=args.capture is not None)
+    output_device.register_speaker(input_device)
+    kokoro_converter.register_sink(output_device, MessageType.TEXT)
+    kokoro_converter.register_sink(output_device, MessageType.AUDIO)
+
+    start_usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    output_device.start()
+    kokoro_converter.start()
+    phi4_broker.start()
+    parakeet_converter.start()
+    input_device.start()
+    for guest in guests:
+        guest.start()
+    if args.chat:
+        chat_converter.start()
+        chat_feed.start()
+    try:
+        input_device.done.wait()
+    except KeyboardInterrupt:
+        pass
+    wall = time.perf_counter() - start
+
+    input_device.stop()
+    for guest in guests:
+        guest.stop()
+    if args.chat:
+        chat_feed.stop()
+        chat_converter.stop()
+    parakeet_converter.stop()
+    phi4_broker.stop()
+    kokoro_converter.stop()
+    output_device.stop()
+    # the model processes have to be gone for their usage to be accounted
+    asr.stop()
+    llm.stop()
+    tts.stop()
+
+    for device in [input_device, *guests]:
+        print(f"[{device.name}] {output_device.replies[device.name]}/{len(device.utterances)} replies")
+    print(f"{output_device.audio_duration:.1f}s of speech")
+    report(exporter, wall, start_usage)
+    if args.capture:
+        output_device.save(args.capture)
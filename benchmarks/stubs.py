@@ -0,0 +1,147 @@
+import copy
+import threading
+import time
+from collections.abc import Iterator
+from typing import Any
+
+import numpy as np
+import tracing
+from messaging import MessageType
+
+# stand-ins for Parakeet, Phi4 and Kokoro82M with the same transforms and a configurable latency, for benchmarking the pipeline itself
+
+
+class StubASR:
+    def __init__(self, latency: float = 0.05, real_time_factor: float = 0.05, text: str = "Bonjour, peux-tu me parler de la météo de demain ?") -> None:
+        self.latency = latency
+        self.real_time_factor = real_time_factor
+        self.text = text
+
+    def transcribe(self, type: MessageType, content: Any) -> list[tuple[MessageType, Any]]:
+        if type != MessageType.AUDIO:
+            return [(MessageType.NONE, None)]
+
+        time.sleep(self.latency + self.real_time_factor * len(content[0]) / content[1])
+        return [(MessageType.TEXT, self.text)]
+
+    def transcribe_batch(self, batch: list[tuple[MessageType, Any]]) -> Iterator[tuple[int, MessageType, Any]]:
+        audios = [(i, content) for i, (type, content) in enumerate(batch) if type == MessageType.AUDIO]
+        if audios:
+            time.sleep(self.latency + self.real_time_factor * max(len(audio) / samplerate for _, (audio, samplerate) in audios))
+        for i, _ in audios:
+            yield (i, MessageType.TEXT, self.text)
+
+    def transcribe_stream(self, type: MessageType, content: Any) -> Iterator[tuple[MessageType, Any]]:
+        if type != MessageType.AUDIO:
+            return
+
+        chunk, samplerate, final, _ = content
+        time.sleep(self.latency + self.real_time_factor * len(chunk) / samplerate)
+        tracing.metrics.observe("asr_stream_decoded_seconds", len(chunk) / samplerate, model="stub")
+        yield (MessageType.TEXT if final else MessageType.INFO, self.text)
+
+    def transcribe_stream_batch(self, batch: list[tuple[MessageType, Any]]) -> Iterator[tuple[int, MessageType, Any]]:
+        # one decode for the chunks of the batch, with an output for the last one or for the final one of an utterance
+        chunks = [(i, content) for i, (type, content) in enumerate(batch) if type == MessageType.AUDIO]
+        if not chunks:
+            return
+
+        duration = sum(len(chunk) / samplerate for _, (chunk, samplerate, _, _) in chunks)
+        time.sleep(self.latency + self.real_time_factor * duration)
+        tracing.metrics.observe("asr_stream_decoded_seconds", duration, model="stub")
+        for i, (_, _, final, _) in chunks:
+            if final:
+                yield (i, MessageType.TEXT, self.text)
+        if not chunks[-1][1][2]:
+            yield (chunks[-1][0], MessageType.INFO, self.text)
+
+
+class StubLLM:
+    def __init__(self, ttft: float = 0.3, tokens_per_second: float = 15.0, sentences: int = 3, words_per_sentence: int = 12) -> None:
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.sentences = sentences
+        self.words_per_sentence = words_per_sentence
+        self.history: list[str] = []
+        self.chat_preempted = threading.Event()
+        self.preempts = 0
+        self.chat_dropped = 0
+        self.lock = threading.Lock()
+
+    def session(self) -> "StubLLM":
+        session = copy.copy(self)
+        session.history = []
+        session.chat_preempted = threading.Event()
+        session.preempts = 0
+        session.chat_dropped = 0
+        session.lock = threading.Lock()
+        return session
+
+    def process_host(self, type: MessageType, content: Any) -> Iterator[tuple[MessageType, Any]]:
+        if type != MessageType.TEXT:
+            return
+
+        self.history.append(content)
+        # the chat goes on after the turn unless another host input arrived meanwhile, as with Phi4
+        with self.lock:
+            preempts = self.preempts
+        try:
+            time.sleep(self.ttft)
+            tracing.metrics.observe("llm_ttft_seconds", self.ttft, model="stub", task="generating")
+            tracing.metrics.observe("llm_tokens_per_second", self.tokens_per_second, model="stub", task="generating")
+            for i in range(self.sentences):
+                # roughly 1.3 tokens per word
+                time.sleep(1.3 * self.words_per_sentence / self.tokens_per_second)
+                yield (MessageType.TEXT, " ".join(["mot"] * self.words_per_sentence) + ".")
+        finally:
+            with self.lock:
+                if self.preempts == preempts:
+                    self.chat_preempted.clear()
+
+    def process_chat_batch(self, batch: list[tuple[MessageType, Any]]) -> Iterator[tuple[int, MessageType, Any]]:
+        # a padded batch costs about as much as its longest sequence, it stops when the host speaks as Phi4 does
+        if self.chat_preempted.wait(self.ttft + 1.3 * self.words_per_sentence / self.tokens_per_second):
+            self.chat_dropped += len(batch)
+            tracing.metrics.observe("llm_chat_dropped", len(batch), model="stub", reason="preempted")
+            return
+        tracing.metrics.observe("llm_chat_batch_size", len(batch), model="stub")
+        for i, (type, content) in enumerate(batch):
+            if type == MessageType.TEXT:
+                yield (i, MessageType.TEXT, " ".join(["mot"] * self.words_per_sentence) + ".")
+
+    def preempt_chat(self) -> None:
+        with self.lock:
+            self.preempts += 1
+            self.chat_preempted.set()
+
+    def mark_spoken(self, text: str, trace_id: int | None = None) -> None:
+        pass
+
+    def interrupt(self) -> None:
+        pass
+
+
+class StubTTS:
+    def __init__(self, real_time_factor: float = 0.2, words_per_second: float = 2.5, samplerate: int = 24000, voice: str = "stub") -> None:
+        self.real_time_factor = real_time_factor
+        self.words_per_second = words_per_second
+        self.samplerate = samplerate
+        self.voice = voice
+
+    def session(self, voice: str | None = None) -> "StubTTS":
+        session = copy.copy(self)
+        session.voice = self.voice if voice is None else voice
+        return session
+
+    def transcribe(self, type: MessageType, content: Any) -> Iterator[tuple[MessageType, Any]]:
+        if type != MessageType.TEXT:
+            return
+
+        duration = len(content.split()) / self.words_per_second
+        time.sleep(self.real_time_factor * duration)
+        tracing.metrics.observe("tts_real_time_factor", self.real_time_factor, model="stub", voice=self.voice)
+        yield (MessageType.TEXT, content)
+        yield (MessageType.AUDIO, (np.zeros(int(duration * self.samplerate), dtype=np.float32), self.samplerate))
+
+    def interrupt(self) -> None:
+        pass
@@ -1,10 +1,17 @@
+import heapq
+import threading
+import time
 from collections import defaultdict
+from collections.abc import Callable, Iterable
 from dataclasses import dataclass, field
 from enum import IntEnum, auto, unique
 from itertools import count
-from queue import PriorityQueue
 from typing import Any
 
+import tqdm
+import tracing
+from tracing import Trace
+
 global_uid = count()
 
 
@@ -21,6 +28,12 @@ class MessageType(IntEnum):
     INFO = auto()
 
 
+# a transform maps one input to zero or more outputs, it may be a generator so that outputs are forwarded as soon as they are yielded
+Transform = Callable[[MessageType, Any], Iterable[tuple[MessageType, Any]]]
+# a batch transform maps several inputs at once, each output is tagged with the index of the input it answers
+BatchTransform = Callable[[list[tuple[MessageType, Any]]], Iterable[tuple[int, MessageType, Any]]]
+
+
 @dataclass
 class MessagingNode:
     uid: int = field(default_factory=new_uid, init=False)
@@ -37,6 +50,11 @@ class MessagingNode:
 class Producer(MessagingNode):
     priority: int = field(default=0)
     msg_counter: count = field(default_factory=count, init=False)
+    last_msg_id: int = field(default=-1, init=False)
+
+    def new_message_id(self) -> int:
+        self.last_msg_id = next(self.msg_counter)
+        return self.last_msg_id
 
 
 @dataclass
@@ -45,17 +63,146 @@ class Message:
     id: int
     type: MessageType
     content: Any
+    trace: Trace | None = field(default_factory=tracing.current)
+
+
+@unique
+class QueuePolicy(IntEnum):
+    # what a full queue does with a new message
+    BLOCK = auto()  # the producer waits for room
+    DROP_OLDEST = auto()  # the oldest queued message is dropped
+    DROP_LOWER_PRIORITY = auto()  # the least important message is dropped, the new one if none is less important
+    COALESCE_LATEST = auto()  # only the latest message of each producer is kept, whether full or not
+
+
+QueueItem = tuple[int, int, float, Message]
+
+
+class SinkQueue:
+    # priority queue, lowest priority value then oldest first, with a capacity, a drop policy and a condition that wakes
+    # the consumer as soon as a message is put or the queue is closed
+    def __init__(self, name: str, capacity: int | None = None, policy: QueuePolicy = QueuePolicy.BLOCK) -> None:
+        self.name = name
+        self.capacity = capacity
+        self.policy = policy
+        self.queue: list[QueueItem] = []
+        self.condition = threading.Condition()
+        self.closed = False
+        # the drops are counted by `sink_queue_drops`, each new high-water mark of the depth is recorded by `sink_queue_high_water`
+        self.high_water = 0
+
+    def qsize(self) -> int:
+        with self.condition:
+            return len(self.queue)
+
+    def drop(self, item: QueueItem) -> None:
+        with tracing.use(item[-1].trace):
+            tracing.metrics.observe("sink_queue_drops", 1, module=self.name, policy=self.policy.name.lower())
+
+    def remove(self, index: int) -> QueueItem:
+        item = self.queue[index]
+        self.queue[index] = self.queue[-1]
+        self.queue.pop()
+        heapq.heapify(self.queue)
+        return item
+
+    def put(self, item: QueueItem) -> bool:
+        with self.condition:
+            if self.policy == QueuePolicy.COALESCE_LATEST:
+                for stale in [queued for queued in self.queue if queued[-1].producer == item[-1].producer]:
+                    self.drop(self.remove(self.queue.index(stale)))
+
+            if self.capacity is not None and len(self.queue) >= self.capacity:
+                match self.policy:
+                    case QueuePolicy.BLOCK:
+                        self.condition.wait_for(lambda: self.closed or len(self.queue) < self.capacity)
+                    case QueuePolicy.DROP_OLDEST | QueuePolicy.COALESCE_LATEST:
+                        self.drop(self.remove(min(range(len(self.queue)), key=lambda i: self.queue[i][1])))
+                    case QueuePolicy.DROP_LOWER_PRIORITY:
+                        # the least important is the one with the highest priority value, the newest of them
+                        index = max(range(len(self.queue)), key=lambda i: self.queue[i][:2])
+                        if self.queue[index][0] <= item[0]:
+                            self.drop(item)
+                            return False
+                        self.drop(self.remove(index))
+
+            if self.closed:
+                return False
+
+            heapq.heappush(self.queue, item)
+            if len(self.queue) > self.high_water:
+                self.high_water = len(self.queue)
+                tracing.metrics.observe("sink_queue_high_water", self.high_water, module=self.name)
+            self.condition.notify_all()
+            return True
+
+    def get(self, timeout: float | None = None) -> QueueItem | None:
+        # None once `timeout` expired or when the queue is closed
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.closed or self.queue, timeout):
+                return None
+            if self.closed:
+                return None
+            item = heapq.heappop(self.queue)
+            self.condition.notify_all()
+            return item
+
+    def filter(self, keep: Callable[[QueueItem], bool]) -> None:
+        with self.condition:
+            self.queue = [item for item in self.queue if keep(item)]
+            heapq.heapify(self.queue)
+            self.condition.notify_all()
+
+    def close(self) -> None:
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def open(self) -> None:
+        with self.condition:
+            self.closed = False
 
 
 class Sink(MessagingNode):
-    def __init__(self, name: str) -> None:
+    def __init__(self, name: str, capacity: int | None = None, policy: QueuePolicy = QueuePolicy.BLOCK) -> None:
         MessagingNode.__init__(self, name=name)
-        self.sink_queue: PriorityQueue[tuple[int, int, Message]] = PriorityQueue()
+        self.sink_queue = SinkQueue(name, capacity, policy)
         self.queue_counter = count()
         self.last_ids: dict[Producer, int] = {}
+        # messages of a trace older than this are stale, per producer or for all of them under None, and messages of a producer
+        # with an id under its cutoff, see `supersede`
+        self.stale_traces: dict[Producer | None, int] = {}
+        self.superseded_ids: dict[Producer, int] = {}
+
+    def set_queue_capacity(self, capacity: int | None, policy: QueuePolicy = QueuePolicy.BLOCK) -> None:
+        self.sink_queue.capacity = capacity
+        self.sink_queue.policy = policy
 
     def receive_message(self, message: Message) -> None:
-        self.sink_queue.put((message.producer.priority, next(self.queue_counter), message))
+        self.sink_queue.put((message.producer.priority, next(self.queue_counter), time.perf_counter(), message))
+
+    def get_message(self, timeout: float | None = None) -> Message | None:
+        # waits for a message, without timeout until one arrives or the queue is closed when the module stops
+        item = self.sink_queue.get(timeout)
+        if item is None:
+            return None
+
+        _, _, enqueued, message = item
+        with tracing.use(message.trace):
+            tracing.metrics.observe("queue_wait_seconds", time.perf_counter() - enqueued, module=self.name)
+            tracing.metrics.observe("sink_queue_depth", self.sink_queue.qsize(), module=self.name)
+
+        if self.is_stale(message):
+            tqdm.tqdm.write(f"[{self.name}] drop message of a superseded turn from [{message.producer.name}]")
+            return None
+
+        if message.producer in self.last_ids:
+            if message.id < self.last_ids[message.producer]:
+                tqdm.tqdm.write(f"[{self.name}] drop old message from [{message.producer.name}]")
+                return None
+
+            self.last_ids[message.producer] = message.id
+        return message
 
     def keep_last_from(self, producer: Producer) -> None:
         self.last_ids[producer] = -1
@@ -64,6 +211,27 @@ class Sink(MessagingNode):
         if producer in self.last_ids:
             del self.last_ids[producer]
 
+    def is_stale(self, message: Message) -> bool:
+        if message.id < self.superseded_ids.get(message.producer, -1):
+            return True
+        if message.trace is None:
+            return False
+        return message.trace.id < max(self.stale_traces.get(message.producer, -1), self.stale_traces.get(None, -1))
+
+    def supersede(self, producer: Producer | None = None) -> None:
+        # every message already sent by `producer` (by any producer if None) is stale, queued ones are dropped right away
+        # and the ones still in flight are dropped on reception, unlike `keep_last_from` the later messages are not ordered,
+        # called under the trace of the turn that supersedes, the messages of older turns are stale too, even those sent later
+        trace = tracing.current()
+        with self.sink_queue.condition:
+            if trace is not None:
+                self.stale_traces[producer] = max(self.stale_traces.get(producer, -1), trace.id)
+            producers = {producer} if producer is not None else {item[-1].producer for item in self.sink_queue.queue} | set(self.superseded_ids)
+            for stale in producers:
+                self.superseded_ids[stale] = stale.last_msg_id + 1
+
+            self.sink_queue.filter(lambda item: not self.is_stale(item[-1]))
+
     def __hash__(self) -> int:
         return self.uid
 
@@ -83,6 +251,6 @@ class Source(Producer):
         self.sinks[message_type].discard(sink)
 
     def send_message(self, message_type: MessageType, content: Any) -> None:
-        msg = Message(self, next(self.msg_counter), message_type, content)
+        msg = Message(self, self.new_message_id(), message_type, content)
         for sink in self.sinks[message_type]:
             sink.receive_message(msg)
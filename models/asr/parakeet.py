@@ -1,18 +1,50 @@
+import copy
+from collections.abc import Iterator
+from dataclasses import dataclass, field
+from itertools import takewhile
 from typing import Any
 
 import nemo.collections.asr as nemo_asr
+import numpy as np
 import torch
+import tracing
 from messaging import Message, MessageType
 from nemo.utils import logging as nemo_logging
 
 nemo_logging.set_verbosity(nemo_logging.ERROR)
 
 
+@dataclass
+class Stream:
+    # the streaming state of one input device: audio not committed yet, committed words and the uncommitted words of the last decode
+    pending: np.ndarray = field(default_factory=lambda: np.zeros(0, dtype=np.float32))
+    committed: list[str] = field(default_factory=list)
+    previous: list[str] = field(default_factory=list)
+
+
 class Parakeet:
-    def __init__(self, device: str = "cpu"):
+    def __init__(self, device: str = "cpu", stream_window: float = 8.0, stream_overlap: float = 2.0, batch_size: int = 8):
         self.model = nemo_asr.models.ASRModel.from_pretrained("nvidia/parakeet-tdt-0.6b-v3", map_location=torch.device(device))
         # self.model.eval()
         # self.model = torch.compile(self.model)
+        # streaming state of each input device, the words two successive decodes agree on are committed and their audio is not
+        # decoded again, except those in the last `stream_overlap` seconds that are decoded again with more right context,
+        # past `stream_window` seconds of pending audio the words before the overlap are committed anyway
+        self.stream_window = stream_window
+        self.stream_overlap = stream_overlap
+        self.streams: dict[str, Stream] = {}
+        self.batch_size = batch_size
+
+    def session(self) -> "Parakeet":
+        # shares the model, with a streaming state of its own
+        session = copy.copy(self)
+        session.streams = {}
+        return session
+
+    def warmup(self) -> None:
+        noise = np.random.default_rng(0).normal(0, 0.01, 16000).astype(np.float32)
+        with torch.inference_mode():
+            self.model.transcribe([noise], batch_size=1, verbose=False)
 
     def transcribe(self, type: MessageType, content: Any) -> list[tuple[MessageType, Any]]:
         if type != MessageType.AUDIO:
@@ -26,3 +58,90 @@ class Parakeet:
 
         print("(transcription)", transcription)
         return [(MessageType.TEXT, transcription)]
+
+    def transcribe_batch(self, batch: list[tuple[MessageType, Any]]) -> Iterator[tuple[int, MessageType, Any]]:
+        # utterances are sorted by length so that those padded together in a batch of `batch_size` have similar lengths
+        indices = sorted((i for i, (type, _) in enumerate(batch) if type == MessageType.AUDIO), key=lambda i: len(batch[i][1][0]), reverse=True)
+        if not indices:
+            return
+
+        with torch.inference_mode():
+            hypotheses = self.model.transcribe([batch[i][1][0] for i in indices], batch_size=self.batch_size, verbose=False)
+
+        for i, hypothesis in zip(indices, hypotheses):
+            if hypothesis.text:
+                print("(transcription)", hypothesis.text)
+                yield (i, MessageType.TEXT, hypothesis.text)
+
+    def transcribe_stream(self, type: MessageType, content: Any) -> Iterator[tuple[MessageType, Any]]:
+        # partial transcriptions are sent as INFO and the final one as TEXT, so that only the latter reaches the LLM
+        if type != MessageType.AUDIO:
+            return
+
+        chunk, samplerate, final, name = content
+        stream = self.streams.setdefault(name, Stream())
+        stream.pending = np.concatenate([stream.pending, chunk.astype(np.float32, copy=False)])
+        yield from self.decode_stream(name, samplerate, final)
+
+    def transcribe_stream_batch(self, batch: list[tuple[MessageType, Any]]) -> Iterator[tuple[int, MessageType, Any]]:
+        # the chunks of each input device queued while the previous ones were decoded are appended together and decoded once,
+        # the outputs answer the final chunk of an utterance that ends in the batch and the last chunk of the device in the batch
+        last: dict[str, tuple[int, int]] = {}
+        for i, (type, content) in enumerate(batch):
+            if type != MessageType.AUDIO:
+                continue
+
+            chunk, samplerate, final, name = content
+            stream = self.streams.setdefault(name, Stream())
+            stream.pending = np.concatenate([stream.pending, chunk.astype(np.float32, copy=False)])
+            last[name] = (i, samplerate)
+            if final:
+                for type, content in self.decode_stream(name, samplerate, final=True):
+                    yield (i, type, content)
+                del last[name]
+
+        for name, (i, samplerate) in last.items():
+            for type, content in self.decode_stream(name, samplerate, final=False):
+                yield (i, type, content)
+
+    def decode_stream(self, name: str, samplerate: int, final: bool) -> Iterator[tuple[MessageType, Any]]:
+        stream = self.streams.pop(name) if final else self.streams[name]
+        hypothesis = None
+        if len(stream.pending):
+            with torch.inference_mode():
+                hypothesis = self.model.transcribe([stream.pending], batch_size=1, timestamps=not final, verbose=False)[0]
+            tracing.metrics.observe("asr_stream_decoded_seconds", len(stream.pending) / samplerate, model="parakeet")
+
+        if final:
+            transcription = " ".join([*stream.committed, hypothesis.text if hypothesis is not None else ""]).strip()
+            if transcription:
+                print("(transcription)", transcription)
+                yield (MessageType.TEXT, transcription)
+            return
+
+        if hypothesis is None:
+            return
+
+        words = hypothesis.timestamp["word"]
+        duration = len(stream.pending) / samplerate
+        horizon = duration - self.stream_overlap
+        agreed = 0
+        for word, previous in zip(words, stream.previous):
+            if word["word"] != previous or word["end"] >= horizon:
+                break
+            agreed += 1
+        if duration > self.stream_window:
+            agreed = max(agreed, sum(1 for _ in takewhile(lambda word: word["end"] < horizon, words)))
+
+        stable = words[:agreed]
+        stream.previous = [word["word"] for word in words[agreed:]]
+        if stable:
+            stream.committed.extend(word["word"] for word in stable)
+            stream.pending = stream.pending[int(stable[-1]["end"] * samplerate) :]
+        elif duration > self.stream_window:
+            # no word ends before the overlap, the audio before it and before the first word is silence
+            stream.pending = stream.pending[int(min([horizon, *(word["start"] for word in words[:1])]) * samplerate) :]
+
+        partial = " ".join([*stream.committed, *stream.previous]).strip()
+        if partial:
+            yield (MessageType.INFO, partial)
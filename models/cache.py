@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+from typing import Any
+
+import numpy as np
+import tracing
+
+
+class LRUCache:
+    # bounded by the summed `weight` of its values, one per value by default
+    def __init__(self, name: str, capacity: float, weight: Callable[[Any], float] = lambda value: 1) -> None:
+        self.name = name
+        self.capacity = capacity
+        self.weight = weight
+        self.entries: OrderedDict[Hashable, Any] = OrderedDict()
+        self.size = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Any | None:
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+        tracing.metrics.observe("cache_hit", float(value is not None), cache=self.name)
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.weight(self.entries.pop(key))
+            self.entries[key] = value
+            self.size += self.weight(value)
+            while self.size > self.capacity and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= self.weight(evicted)
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0
+
+
+def digest(key: str) -> str:
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+class ArrayStore:
+    # arrays saved as .npy files named after their key, they are memory-mapped when read back,
+    # bounded by their summed size in bytes: the least recently used files, by modification time across restarts, are removed
+    def __init__(self, name: str, directory: str, capacity: int = 1 << 30) -> None:
+        self.name = name
+        self.directory = directory
+        self.capacity = capacity
+        self.files: OrderedDict[str, int] = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        entries = []
+        for entry in os.scandir(directory):
+            if entry.name.endswith(".tmp"):
+                # left by a crash during a write
+                os.remove(entry.path)
+            elif entry.name.endswith(".npy"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.path, stat.st_size))
+        for _, path, size in sorted(entries):
+            self.files[path] = size
+            self.size += size
+        with self.lock:
+            self.evict()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, digest(key) + ".npy")
+
+    def get(self, key: str) -> np.ndarray | None:
+        path = self.path(key)
+        try:
+            value = np.load(path, mmap_mode="r")
+            with self.lock:
+                if path in self.files:
+                    self.files.move_to_end(path)
+            os.utime(path)
+        except FileNotFoundError:
+            value = None
+        tracing.metrics.observe("cache_hit", float(value is not None), cache=self.name)
+        return value
+
+    def put(self, key: str, value: np.ndarray) -> None:
+        # written aside under a name of its own and renamed, so that a reader never sees a partial file and concurrent writers
+        # of the same key do not write into the same file
+        path = self.path(key)
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix=".tmp", delete=False) as f:
+            np.save(f, value)
+        size = os.path.getsize(f.name)
+        os.replace(f.name, path)
+        with self.lock:
+            self.size += size - self.files.pop(path, 0)
+            self.files[path] = size
+            self.evict()
+
+    def evict(self) -> None:
+        while self.size > self.capacity and len(self.files) > 1:
+            path, size = self.files.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            tracing.metrics.observe("cache_evictions", 1, cache=self.name)
+
+
+class JsonStore:
+    # small values appended to a json lines file, all loaded at startup and bounded in number of entries: the least recently
+    # used are forgotten, and the file is rewritten with the live entries once it holds twice as many lines
+    def __init__(self, name: str, path: str, capacity: int = 65536) -> None:
+        self.name = name
+        self.path = path
+        self.capacity = capacity
+        self.values: OrderedDict[str, Any] = OrderedDict()
+        self.lines = 0
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    self.lines += 1
+                    try:
+                        key, value = json.loads(line)
+                    except ValueError:
+                        # the last line may have been cut by a crash
+                        continue
+                    self.values[key] = value
+                    self.values.move_to_end(key)
+        while len(self.values) > capacity:
+            self.values.popitem(last=False)
+        self.file = open(path, "a", encoding="utf-8", buffering=1)
+        if self.lines > 2 * len(self.values):
+            with self.lock:
+                self.compact()
+
+    def get(self, key: str) -> Any | None:
+        with self.lock:
+            value = self.values.get(key)
+            if value is not None:
+                self.values.move_to_end(key)
+        tracing.metrics.observe("cache_hit", float(value is not None), cache=self.name)
+        return value
+
+    def put(self, key: str, value: Any) -> None:
+        with self.lock:
+            if key in self.values:
+                return
+            self.values[key] = value
+            self.file.write(json.dumps([key, value], ensure_ascii=False) + "\n")
+            self.lines += 1
+            if len(self.values) > self.capacity:
+                self.values.popitem(last=False)
+                tracing.metrics.observe("cache_evictions", 1, cache=self.name)
+            if self.lines > 2 * self.capacity:
+                self.compact()
+
+    def compact(self) -> None:
+        # the live entries, least recently used first so that they are the first forgotten after a restart, written aside and renamed
+        self.file.close()
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=os.path.dirname(self.path) or ".", suffix=".tmp", delete=False) as f:
+            for key, value in self.values.items():
+                f.write(json.dumps([key, value], ensure_ascii=False) + "\n")
+        os.replace(f.name, self.path)
+        self.lines = len(self.values)
+        self.file = open(self.path, "a", encoding="utf-8", buffering=1)
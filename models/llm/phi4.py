@@ -1,12 +1,117 @@
+import copy
+import re
 import threading
+import time
 from collections import defaultdict
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
 from typing import Any
 
 import numpy as np
 import torch
 import tqdm
+import tracing
 from messaging import Message, MessageType
-from transformers import AutoModelForCausalLM, AutoProcessor, AutoTokenizer, GenerationConfig, TextIteratorStreamer
+from models.snapshot import SnapshotWriter, load_snapshot
+from torch.nn.utils.rnn import pad_sequence
+from transformers import (
+    AutoModelForCausalLM,
+    AutoProcessor,
+    AutoTokenizer,
+    BatchEncoding,
+    DynamicCache,
+    GenerationConfig,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TextIteratorStreamer,
+)
+
+SENTENCE_END = re.compile(r"(?<=[.!?…])\s+|\n+")
+WORD_CHARACTER = re.compile(r"\w")
+AUDIO_PLACEHOLDER = re.compile(r"<\|audio_(\d+)\|>")
+# the special token that stands for one embedding of a clip, and the input mode that switches the model to its speech adapter
+AUDIO_TOKEN = "<|endoftext11|>"
+SPEECH_MODE = 2
+
+
+def split_sentences(text: str) -> tuple[list[str], str]:
+    *sentences, rest = SENTENCE_END.split(text)
+    return [sentence.strip() for sentence in sentences if sentence.strip()], rest
+
+
+QUANTIZATIONS = ("int8_dynamic", "int8_weight_only", "int4_weight_only")
+
+
+def quantize(model: torch.nn.Module, quantization: str, device: str) -> None:
+    # the linear layers are quantized in place by torchao, which is only needed when a quantization is asked for
+    from torchao.dtypes import Int4CPULayout
+    from torchao.quantization import Int4WeightOnlyConfig, Int8DynamicActivationInt8WeightConfig, Int8WeightOnlyConfig, quantize_
+
+    match quantization:
+        case "int8_dynamic":
+            config = Int8DynamicActivationInt8WeightConfig()
+        case "int8_weight_only":
+            config = Int8WeightOnlyConfig()
+        case "int4_weight_only":
+            # the default int4 layout packs the weights for the CUDA kernels
+            config = Int4WeightOnlyConfig(group_size=128, layout=Int4CPULayout()) if device == "cpu" else Int4WeightOnlyConfig(group_size=128)
+        case _:
+            raise ValueError(f"unknown quantization {quantization!r}, expected one of {QUANTIZATIONS}")
+
+    quantize_(model, config)
+
+
+class MeteredStreamer(TextIteratorStreamer):
+    def __init__(self, tokenizer: AutoTokenizer, **kwargs: Any) -> None:
+        TextIteratorStreamer.__init__(self, tokenizer, **kwargs)
+        self.start = time.perf_counter()
+        self.first_token: float | None = None
+        self.prompt_tokens = 0
+        self.tokens = 0
+        # forward passes of the model and drafted tokens they verified, counted with assisted decoding
+        self.forwards = 0
+        self.drafted = 0
+
+    def put(self, value: torch.Tensor) -> None:
+        if self.skip_prompt and self.next_tokens_are_prompt:
+            self.prompt_tokens = value.shape[-1]
+        else:
+            if self.first_token is None:
+                self.first_token = time.perf_counter()
+            self.tokens += value.numel()
+        TextIteratorStreamer.put(self, value)
+
+    def count_forward(self, end: int) -> None:
+        # the input of a forward pass ends at `end`, what goes beyond the prompt and the tokens generated so far is a draft
+        self.forwards += 1
+        self.drafted += max(0, end - self.prompt_tokens - self.tokens)
+
+    @property
+    def ttft(self) -> float:
+        return (self.first_token or time.perf_counter()) - self.start
+
+    @property
+    def tokens_per_second(self) -> float:
+        elapsed = time.perf_counter() - (self.first_token or self.start)
+        return (self.tokens - 1) / elapsed if self.tokens > 1 and elapsed > 0 else 0.0
+
+    @property
+    def tokens_per_forward(self) -> float:
+        return self.tokens / self.forwards if self.forwards else 0.0
+
+    @property
+    def acceptance_rate(self) -> float:
+        # each pass yields the drafted tokens it accepted plus one of its own
+        return (self.tokens - self.forwards) / self.drafted if self.drafted else 0.0
+
+
+class EventStoppingCriteria(StoppingCriteria):
+    def __init__(self, event: threading.Event) -> None:
+        self.event = event
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs: Any) -> torch.BoolTensor:
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
 
 
 class Phi4:
@@ -19,7 +124,19 @@ class Phi4:
         context_size_limit: int = 100000,
         system_prompt_summary: str = "",
         device: str = "auto",
+        reuse_cache: bool = True,
+        summary_threshold: float = 0.8,
+        summary_keep: float = 0.25,
+        prefill_chunk_size: int = 512,
+        quantization: str | None = None,
+        prompt_lookup_num_tokens: int | None = None,
+        assistant_model_path: str | None = None,
+        snapshot_path: str | None = None,
+        snapshot_interval: float = 30.0,
+        chat_history_size: int = 8,
+        temperature: float = 0.7,
     ) -> None:
+        self.model_path = model_path
         self.model = AutoModelForCausalLM.from_pretrained(
             model_path,
             device_map=device,
@@ -27,87 +144,538 @@ class Phi4:
             dtype=torch.bfloat16,
             trust_remote_code=True,
         ).eval()
+        if quantization is not None:
+            quantize(self.model, quantization, device)
         self.model = torch.compile(self.model)
         self.tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+        # assisted decoding, drafts come from n-grams of the prompt or from a smaller model sharing the tokenizer,
+        # they are verified in a single forward pass so that greedy outputs are unchanged
+        self.prompt_lookup_num_tokens = prompt_lookup_num_tokens
+        self.assistant_model = (
+            AutoModelForCausalLM.from_pretrained(assistant_model_path, device_map=device, dtype=torch.bfloat16, trust_remote_code=True).eval()
+            if assistant_model_path is not None
+            else None
+        )
+        self.streamers: dict[int, MeteredStreamer] = {}
+        getattr(self.model, "_orig_mod", self.model).register_forward_pre_hook(self.count_forward, with_kwargs=True)
+        self.tokens_per_forward = 0.0
+        self.acceptance_rate = 0.0
         self.generation_config = GenerationConfig.from_pretrained(model_path)
-        self.history_host: list[dict[str, str]] = [{"role": "system", "content": system_prompt_host}]
-        self.history_chat: dict[str, list[dict[str, str]]] = defaultdict(lambda: [{"role": "system", "content": system_prompt_chat}])
+        self.generation_prompt_tokens = self.message_tokens({"role": "user", "content": ""}, add_generation_prompt=True) - self.message_tokens(
+            {"role": "user", "content": ""}
+        )
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
         self.max_new_tokens = max_new_tokens
         self.context_size_limit = context_size_limit
         self.system_prompt_summary = system_prompt_summary
+        # keys/values of the host conversation are kept between turns, `cache_ids` holds the tokens they were computed from
+        self.reuse_cache = reuse_cache
+        self.ttft = 0.0
+        self.tokens_per_second = 0.0
+        # the history is compacted in the background once it goes over `summary_threshold` of the limit, a new host turn pre-empts it
+        self.summary_threshold = summary_threshold
+        self.summary_keep = summary_keep
+        self.prefill_chunk_size = prefill_chunk_size
+        self.unspoken_tolerance = 0.1
+        # the replies are sampled at `temperature`, 0 decodes them greedily so that two runs give the same tokens
+        self.temperature = temperature
+        # the history of a viewer keeps its system prompt and its last `chat_history_size` exchanges
+        self.chat_history_size = chat_history_size
+        self.system_prompt_host = system_prompt_host
+        self.system_prompt_chat = system_prompt_chat
+        self.snapshot_interval = snapshot_interval
+        self.start_conversation(system_prompt_host, system_prompt_chat, snapshot_path, snapshot_interval)
+
+    def start_conversation(self, system_prompt_host: str, system_prompt_chat: str, snapshot_path: str | None, snapshot_interval: float) -> None:
+        self.history_host: list[dict[str, str]] = [{"role": "system", "content": system_prompt_host}]
+        # token count of each history entry, kept in step with `history_host` so that its size is known without tokenizing it
+        self.history_host_tokens = [self.message_tokens(self.history_host[0])]
+        self.history_host_size = self.history_host_tokens[0]
+        self.history_chat: dict[str, list[dict[str, str]]] = defaultdict(lambda: [{"role": "system", "content": system_prompt_chat}])
+        # viewer comments are generated in batches, which give way to the host as soon as they speak: `preempt_chat` is sent on the
+        # controls channel when host input arrives, it stops the running batch and those queued before the host turn,
+        # `preempts` counts them so that a host turn only lets the chat go on if no other host input arrived while it ran
+        self.chat_preempted = threading.Event()
+        self.preempts = 0
+        self.chat_dropped = 0
+        self.cache: DynamicCache | None = None
+        self.cache_ids: torch.Tensor | None = None
+        self.compaction_thread: threading.Thread | None = None
+        self.compaction_stop = threading.Event()
+        # the compaction runs next to the calls, a host turn cancels it and a chat batch waits for it, so that two generations
+        # never share the model
+        self.generation_lock = threading.Lock()
+        # a barge-in stops the generation and only the part of the reply that was actually played is kept in the history,
+        # `unspoken` counts the word characters of the last reply that were not reported by `mark_spoken` yet
+        self.lock = threading.Lock()
+        self.interrupted = threading.Event()
+        self.spoken: list[str] = []
+        self.unspoken = 0
+        self.reply_trace: int | None = None
+        # the conversation and its keys/values are saved to `snapshot_path` in the background at most every `snapshot_interval`
+        # seconds and after each compaction, a restart resumes from there without prefilling the history again
+        self.snapshots = SnapshotWriter("phi4", snapshot_path, snapshot_interval) if snapshot_path is not None else None
+        if snapshot_path is not None:
+            self.restore(snapshot_path)
+
+    def session(
+        self,
+        system_prompt_host: str | None = None,
+        system_prompt_chat: str | None = None,
+        snapshot_path: str | None = None,
+        snapshot_interval: float | None = None,
+    ) -> "Phi4":
+        # shares the model, the tokenizer and the settings, with a conversation of its own
+        session = copy.copy(self)
+        session.start_conversation(
+            self.system_prompt_host if system_prompt_host is None else system_prompt_host,
+            self.system_prompt_chat if system_prompt_chat is None else system_prompt_chat,
+            snapshot_path,
+            self.snapshot_interval if snapshot_interval is None else snapshot_interval,
+        )
+        return session
 
-    @staticmethod
-    def progress(streamer: TextIteratorStreamer, description: str, max_new_tokens: int) -> None:
-        for _ in tqdm.tqdm(streamer, desc=description, total=max_new_tokens + 1):
+    def warmup(self) -> None:
+        inputs = self.tokenizer.apply_chat_template(
+            [self.history_host[0], {"role": "user", "content": "Bonjour !"}], add_generation_prompt=True, return_dict=True, return_tensors="pt"
+        ).to(self.model.device)
+        for _ in self.stream(inputs, "Warming up", 8, do_sample=False):
             pass
 
-    def summurize(self, history: list[dict[str, str]]) -> str:
+    def chat_inputs(self, history: list[dict[str, str]]) -> BatchEncoding:
+        return self.tokenizer.apply_chat_template(history, add_generation_prompt=True, return_dict=True, return_tensors="pt").to(self.model.device)
+
+    def message_tokens(self, message: dict[str, str], add_generation_prompt: bool = False) -> int:
+        return len(self.tokenizer.apply_chat_template([message], add_generation_prompt=add_generation_prompt, return_dict=True)["input_ids"])
+
+    def append_host(self, role: str, content: str) -> None:
+        self.history_host.append({"role": role, "content": content})
+        self.history_host_tokens.append(self.message_tokens(self.history_host[-1]))
+        self.history_host_size += self.history_host_tokens[-1]
+
+    def replace_host(self, history: list[dict[str, str]], tokens: list[int]) -> None:
+        self.history_host = history
+        self.history_host_tokens = tokens
+        self.history_host_size = sum(tokens)
+
+    def reset_host(self) -> None:
+        self.cancel_compaction()
+        self.replace_host(self.history_host[:1], self.history_host_tokens[:1])
+        self.cache = self.cache_ids = None
+        self.save_snapshot(force=True)
+
+    def snapshot_state(self) -> dict[str, Any]:
+        # the cache appends by building new tensors, the ones referenced here stay as they are while the next turn goes on
+        layers = [self.cache[layer] for layer in range(len(self.cache))] if self.cache is not None and self.cache_ids is not None else []
+        return {
+            "model": self.model_path,
+            "history": [dict(message) for message in self.history_host],
+            "tokens": list(self.history_host_tokens),
+            "cache_ids": self.cache_ids.cpu() if layers else None,
+            "keys": [keys.cpu() for keys, _ in layers],
+            "values": [values.cpu() for _, values in layers],
+        }
+
+    def restore_state(self, state: dict[str, Any]) -> None:
+        # the configured system prompt wins over the one of the snapshot: the turns are kept behind it, and the keys/values,
+        # which all follow the old prompt, are dropped so that the next turn prefills the history again
+        history, tokens = state["history"], state["tokens"]
+        prompt_changed = history[0] != self.history_host[0]
+        if prompt_changed:
+            tqdm.tqdm.write("[phi4] system prompt changed since the snapshot, its keys/values are dropped")
+            history, tokens = [self.history_host[0], *history[1:]], [self.history_host_tokens[0], *tokens[1:]]
+        self.replace_host(history, tokens)
+        self.cache = self.cache_ids = None
+        # keys/values only hold for the model that computed them, the history alone is prefilled on the next turn otherwise
+        if self.reuse_cache and not prompt_changed and state["cache_ids"] is not None and state["model"] == self.model_path:
+            self.cache = DynamicCache()
+            for layer, (keys, values) in enumerate(zip(state["keys"], state["values"])):
+                self.cache.update(keys.to(self.model.device), values.to(self.model.device), layer)
+            self.cache_ids = state["cache_ids"].to(self.model.device)
+
+    def save_snapshot(self, force: bool = False) -> None:
+        if self.snapshots is None or not (force or self.snapshots.due):
+            return
+        with self.lock:
+            state = self.snapshot_state()
+        self.snapshots.save(state)
+
+    def restore(self, path: str) -> bool:
+        start = time.perf_counter()
+        state = load_snapshot(path)
+        if state is None:
+            return False
+
+        self.restore_state(state)
+        cached = len(self.cache_ids) if self.cache_ids is not None else 0
+        tqdm.tqdm.write(
+            f"[phi4] resumed {len(self.history_host)} messages ({self.history_host_size} tokens, {cached} cached)"
+            f" in {time.perf_counter() - start:.2f}s"
+        )
+        return True
+
+    def close(self) -> None:
+        self.cancel_compaction()
+        if self.snapshots is not None:
+            self.save_snapshot(force=True)
+            self.snapshots.flush()
+
+    def prefix_cache(self, input_ids: torch.Tensor) -> DynamicCache | None:
+        if not self.reuse_cache:
+            return None
+
+        # only the longest common prefix is still valid, the last prompt token is always left out so that generate has something to process
+        prefix = 0
+        if self.cache is not None and self.cache_ids is not None:
+            length = min(len(self.cache_ids), len(input_ids[0]) - 1)
+            mismatch = torch.nonzero(self.cache_ids[:length] != input_ids[0, :length].to(self.cache_ids.device))
+            prefix = int(mismatch[0, 0]) if len(mismatch) else length
+
+        if prefix == 0:
+            self.cache = DynamicCache()
+            self.cache_ids = input_ids[0, :0]
+        else:
+            self.cache.crop(prefix)
+            self.cache_ids = self.cache_ids[:prefix]
+
+        return self.cache
+
+    def sampling(self) -> dict[str, Any]:
+        if self.temperature > 0:
+            return {"do_sample": True, "temperature": self.temperature}
+        return {"do_sample": False}
+
+    def assisted_decoding(self) -> dict[str, Any]:
+        if self.assistant_model is not None:
+            return {"assistant_model": self.assistant_model}
+        if self.prompt_lookup_num_tokens:
+            return {"prompt_lookup_num_tokens": self.prompt_lookup_num_tokens}
+        return {}
+
+    def count_forward(self, module: torch.nn.Module, args: tuple, kwargs: dict[str, Any]) -> None:
+        streamer = self.streamers.get(threading.get_ident())
+        if streamer is None:
+            return
+
+        inputs = kwargs.get("input_ids") if kwargs.get("input_ids") is not None else kwargs.get("inputs_embeds")
+        cache = kwargs.get("past_key_values")
+        streamer.count_forward((cache.get_seq_length() if cache is not None else 0) + inputs.shape[1])
+
+    def generate(self, inputs: BatchEncoding, streamer: MeteredStreamer, **kwargs: Any) -> None:
+        cache = kwargs.get("past_key_values")
+        # the forward passes made by this thread are counted by its streamer
+        self.streamers[threading.get_ident()] = streamer
+        try:
+            with torch.inference_mode():
+                out = self.model.generate(**inputs, generation_config=self.generation_config, streamer=streamer, **kwargs)
+            if cache is not None:
+                # the cache covers the prompt and every generated token but the last one
+                self.cache_ids = out[0, : cache.get_seq_length()]
+        except Exception as e:
+            print("error:", e)
+            if cache is not None:
+                self.cache = self.cache_ids = None
+            # unblock the consumer, it would wait forever otherwise
+            streamer.end()
+        finally:
+            del self.streamers[threading.get_ident()]
+
+    def stream(self, inputs: BatchEncoding, description: str, max_new_tokens: int, **kwargs: Any) -> Iterator[str]:
+        streamer = MeteredStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        generation_thread = threading.Thread(target=self.generate, args=(inputs, streamer), kwargs={"max_new_tokens": max_new_tokens, **kwargs})
+        generation_thread.start()
+        try:
+            yield from tqdm.tqdm(streamer, desc=description, total=max_new_tokens + 1)
+        finally:
+            generation_thread.join()
+            self.ttft, self.tokens_per_second = streamer.ttft, streamer.tokens_per_second
+            tracing.metrics.observe("llm_ttft_seconds", self.ttft, model="phi4", task=description.lower())
+            tracing.metrics.observe("llm_tokens_per_second", self.tokens_per_second, model="phi4", task=description.lower())
+            if "assistant_model" in kwargs or "prompt_lookup_num_tokens" in kwargs:
+                self.tokens_per_forward, self.acceptance_rate = streamer.tokens_per_forward, streamer.acceptance_rate
+                tracing.metrics.observe("llm_tokens_per_forward", self.tokens_per_forward, model="phi4", task=description.lower())
+                tracing.metrics.observe("llm_draft_acceptance_rate", self.acceptance_rate, model="phi4", task=description.lower())
+
+    def stream_sentences(self, inputs: BatchEncoding, description: str, max_new_tokens: int, reply: list[str], **kwargs: Any) -> Iterator[str]:
+        # the whole reply is accumulated in `reply` so that the caller can record it once the stream is exhausted
+        buffer = ""
+        for text in self.stream(inputs, description, max_new_tokens, **kwargs):
+            reply.append(text)
+            sentences, buffer = split_sentences(buffer + text)
+            yield from sentences
+
+        if buffer.strip():
+            yield buffer.strip()
+
+    def summurize(self, history: list[dict[str, str]], stop: threading.Event | None = None) -> str:
         summary = [{"role": "system", "content": self.system_prompt_summary}] + history
-        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
-        streamer_thread = threading.Thread(target=Phi4.progress, args=(streamer, "Summurizing", self.max_new_tokens))
-        streamer_thread.start()
-        inputs = self.tokenizer.apply_chat_template(summary, add_generation_prompt=True, return_dict=True, return_tensors="pt").to(self.model.device)
-        out = self.model.generate(**inputs, max_new_tokens=self.max_new_tokens, generation_config=self.generation_config, streamer=streamer)
-        streamer_thread.join()
-        text = self.tokenizer.decode(out[0][len(inputs["input_ids"][0]) :], skip_special_tokens=True)
+        inputs = self.chat_inputs(summary)
+        stopping_criteria = StoppingCriteriaList([EventStoppingCriteria(stop)]) if stop is not None else None
+        text = "".join(
+            self.stream(inputs, "Summurizing", self.max_new_tokens, stopping_criteria=stopping_criteria, **self.assisted_decoding())
+        ).strip()
         print(text, "\n")
         return text
 
-    def process_host(self, type: MessageType, content: Any) -> list[tuple[MessageType, Any]]:
-        if type != MessageType.TEXT:
-            return [(MessageType.NONE, None)]
+    def summary_split(self, history: list[dict[str, str]], tokens: list[int]) -> int:
+        # the most recent messages that fit in `summary_keep` of the limit are kept as is, the kept part starts with a user message
+        has_summary = history[1]["role"] == "system"
+        lowest, highest = 3 + has_summary, len(history) - 1
+        budget = self.summary_keep * self.context_size_limit
+        split, kept = len(history), 0
+        while split > lowest and kept + tokens[split - 1] <= budget:
+            split -= 1
+            kept += tokens[split]
 
-        self.history_host.append({"role": "user", "content": content})
-        try:
-            with torch.inference_mode():
-                inputs = self.tokenizer.apply_chat_template(self.history_host, add_generation_prompt=True, return_dict=True, return_tensors="pt").to(
-                    self.model.device
-                )
-                if len(inputs["input_ids"][0]) > self.context_size_limit:
-                    has_summary = self.history_host[1]["role"] == "system"
-                    self.history_host = [
-                        self.history_host[0],
-                        {"role": "system", "content": self.summurize(self.history_host[1 : max(3 + has_summary, len(self.history_host) - 7)])},
-                        *self.history_host[max(3 + has_summary, len(self.history_host) - 7) :],
-                    ]
-                    inputs = self.tokenizer.apply_chat_template(self.history_host, add_generation_prompt=True, return_dict=True, return_tensors="pt").to(
-                        self.model.device
-                    )
+        while split < highest and history[split]["role"] != "user":
+            split += 1
+
+        return max(lowest, min(split, highest))
+
+    def compacted_history(
+        self, history: list[dict[str, str]], tokens: list[int], stop: threading.Event | None = None
+    ) -> tuple[list[dict[str, str]], list[int]] | None:
+        split = self.summary_split(history, tokens)
+        summary = {"role": "system", "content": self.summurize(history[1:split], stop)}
+        if stop is not None and stop.is_set():
+            return None
 
-                streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
-                streamer_thread = threading.Thread(target=Phi4.progress, args=(streamer, "Generating", 512))
-                streamer_thread.start()
-                out = self.model.generate(
-                    **inputs, max_new_tokens=512, generation_config=self.generation_config, do_sample=True, temperature=0.7, streamer=streamer
-                )
-                streamer_thread.join()
-                text = self.tokenizer.decode(out[0][len(inputs["input_ids"][0]) :], skip_special_tokens=True)
-                self.history_host.append({"role": "assistant", "content": text})
-                print("(generation)", text)
-                return [(MessageType.TEXT, text)]
+        return [history[0], summary, *history[split:]], [tokens[0], self.message_tokens(summary), *tokens[split:]]
+
+    def prefill(self, history: list[dict[str, str]], stop: threading.Event) -> tuple[DynamicCache, torch.Tensor] | None:
+        input_ids = self.tokenizer.apply_chat_template(history, return_dict=True, return_tensors="pt")["input_ids"].to(self.model.device)
+        cache = DynamicCache()
+        # chunked so that a new host turn does not wait for the whole prefill
+        for start in range(0, input_ids.shape[1], self.prefill_chunk_size):
+            if stop.is_set():
+                return None
+            self.model(input_ids=input_ids[:, start : start + self.prefill_chunk_size], past_key_values=cache, use_cache=True, logits_to_keep=1)
+
+        return cache, input_ids[0]
+
+    def compact(self) -> None:
+        history = self.history_host
+        length = len(history)
+        try:
+            with self.generation_lock, torch.inference_mode():
+                compacted = self.compacted_history(history[:length], self.history_host_tokens[:length], self.compaction_stop)
+                if compacted is None:
+                    return
+                prefilled = self.prefill(compacted[0], self.compaction_stop) if self.reuse_cache else None
+                if self.reuse_cache and prefilled is None:
+                    return
         except Exception as e:
             print("error:", e)
-            return [(MessageType.NONE, None)]
+            return
+
+        # the history and its cache are swapped together, only if no turn happened meanwhile
+        with self.lock:
+            if self.compaction_stop.is_set() or self.history_host is not history or len(history) != length:
+                return
+
+            self.replace_host(*compacted)
+            if prefilled is not None:
+                self.cache, self.cache_ids = prefilled
+        tqdm.tqdm.write(f"[phi4] history compacted from {length} to {len(self.history_host)} messages ({self.history_host_size} tokens)")
+        self.save_snapshot(force=True)
+
+    def start_compaction(self) -> None:
+        if self.context_size_limit <= 0 or self.history_host_size <= self.summary_threshold * self.context_size_limit:
+            return
 
-    def process_chat(self, type: MessageType, content: Any) -> list[tuple[MessageType, Any]]:
+        if self.compaction_thread is None or not self.compaction_thread.is_alive():
+            self.compaction_stop.clear()
+            self.compaction_thread = threading.Thread(target=self.compact, name="phi4_compaction", daemon=True)
+            self.compaction_thread.start()
+
+    def cancel_compaction(self) -> None:
+        if self.compaction_thread is not None:
+            self.compaction_stop.set()
+            self.compaction_thread.join()
+            self.compaction_thread = None
+
+    def mark_spoken(self, text: str, trace_id: int | None = None) -> None:
+        # the output device also plays chat replies and what was left of previous turns, only the current reply counts
+        with self.lock:
+            if trace_id is not None and trace_id != self.reply_trace:
+                return
+            self.spoken.append(text)
+            self.unspoken -= len(WORD_CHARACTER.findall(text))
+
+    def interrupt(self) -> None:
+        self.interrupted.set()
+        with self.lock:
+            self.truncate_reply()
+
+    def truncate_reply(self) -> None:
+        last = self.history_host[-1]
+        if last["role"] != "assistant" or self.unspoken <= self.unspoken_tolerance * len(WORD_CHARACTER.findall(last["content"])):
+            return
+
+        self.compaction_stop.set()
+        spoken = " ".join(self.spoken).strip()
+        self.replace_host(self.history_host[:-1], self.history_host_tokens[:-1])
+        if spoken:
+            self.append_host("assistant", f"{spoken} …")
+        self.unspoken = 0
+        tqdm.tqdm.write(f"[phi4] reply interrupted after: {spoken}")
+
+    def process_host(self, type: MessageType, content: Any) -> Iterator[tuple[MessageType, Any]]:
+        with self.host_turn():
+            yield from self.reply_host(type, content)
+
+    def reply_host(self, type: MessageType, content: Any) -> Iterator[tuple[MessageType, Any]]:
         if type != MessageType.TEXT:
-            return [(MessageType.NONE, None)]
+            return
 
-        user, comment = content.split(":")
-        self.history_chat[user].append({"role": "user", "content": comment.strip()})
+        self.cancel_compaction()
+        self.interrupted.clear()
+        with self.lock:
+            self.spoken = []
+            self.unspoken = 0
+            trace = tracing.current()
+            self.reply_trace = trace.id if trace is not None else None
+        self.append_host("user", content)
         try:
             with torch.inference_mode():
-                inputs = self.tokenizer.apply_chat_template(self.history_host, add_generation_prompt=True, return_dict=True, return_tensors="pt").to(
-                    self.model.device
-                )
-                out = self.model.generate(**inputs, max_new_tokens=256, generation_config=self.generation_config, do_sample=True, temperature=0.7)
-                text = self.tokenizer.decode(out[0][len(inputs["input_ids"][0]) :], skip_special_tokens=True)
+                if self.history_host_size + self.generation_prompt_tokens > self.context_size_limit:
+                    # the background compaction did not happen in time
+                    self.replace_host(*self.compacted_history(self.history_host, self.history_host_tokens))
+
+                inputs = self.chat_inputs(self.history_host)
+
+            reply: list[str] = []
+            cache = self.prefix_cache(inputs["input_ids"])
+            stopping_criteria = StoppingCriteriaList([EventStoppingCriteria(self.interrupted)])
+            for sentence in self.stream_sentences(
+                inputs,
+                "Generating",
+                self.max_new_tokens,
+                reply,
+                past_key_values=cache,
+                stopping_criteria=stopping_criteria,
+                **self.sampling(),
+                **self.assisted_decoding(),
+            ):
+                if self.interrupted.is_set():
+                    break
+                yield (MessageType.TEXT, sentence)
         except Exception as e:
             print("error:", e)
-            return [(MessageType.NONE, None)]
+            return
+
+        text = "".join(reply).strip()
+        with self.lock:
+            self.append_host("assistant", text)
+            self.unspoken += len(WORD_CHARACTER.findall(text))
+            if self.interrupted.is_set():
+                self.truncate_reply()
+        print("(generation)", text)
+        self.start_compaction()
+        self.save_snapshot()
+
+    @contextmanager
+    def host_turn(self) -> Iterator[None]:
+        # the pre-emption arrives on the controls channel, unordered with the host turn it announces: the chat goes on once
+        # the turn is over, unless a pre-emption was received meanwhile, which is for a host turn still to come
+        with self.lock:
+            preempts = self.preempts
+        try:
+            yield
+        finally:
+            with self.lock:
+                if self.preempts == preempts:
+                    self.chat_preempted.clear()
+
+    def preempt_chat(self) -> None:
+        with self.lock:
+            self.preempts += 1
+            self.chat_preempted.set()
 
-        self.history_host.append({"role": "assistant", "content": text})
-        return [(MessageType.TEXT, text)]
+    def drop_chat(self, count: int) -> None:
+        self.chat_dropped += count
+        tracing.metrics.observe("llm_chat_dropped", count, model="phi4", reason="preempted")
+        tqdm.tqdm.write(f"[phi4] chat batch of {count} pre-empted by the host ({self.chat_dropped} comments dropped so far)")
+
+    def process_chat_batch(self, batch: list[tuple[MessageType, Any]]) -> Iterator[tuple[int, MessageType, Any]]:
+        # the comments of a batch are answered by a single left-padded generation, each with the history of its viewer,
+        # the comments of a viewer appearing several times in the batch are answered together
+        comments: dict[str, list[str]] = defaultdict(list)
+        answers: dict[str, int] = {}
+        for i, (type, content) in enumerate(batch):
+            if type != MessageType.TEXT or ":" not in content:
+                continue
+            user, comment = content.split(":", 1)
+            comments[user.strip()].append(comment.strip())
+            answers[user.strip()] = i
+
+        if not comments:
+            return
+
+        users = list(comments)
+        with self.generation_lock:
+            if self.chat_preempted.is_set():
+                # queued before a host turn that is still to come
+                self.drop_chat(len(users))
+                return
+
+            for user in users:
+                self.history_chat[user].append({"role": "user", "content": "\n".join(comments[user])})
+            try:
+                with torch.inference_mode():
+                    texts = [self.tokenizer.apply_chat_template(self.history_chat[user], add_generation_prompt=True, tokenize=False) for user in users]
+                    inputs = self.tokenizer(texts, padding=True, padding_side="left", add_special_tokens=False, return_tensors="pt").to(self.model.device)
+                    start = time.perf_counter()
+                    out = self.model.generate(
+                        **inputs,
+                        max_new_tokens=256,
+                        generation_config=self.generation_config,
+                        **self.sampling(),
+                        pad_token_id=self.tokenizer.pad_token_id,
+                        stopping_criteria=StoppingCriteriaList([EventStoppingCriteria(self.chat_preempted)]),
+                    )
+                    elapsed = time.perf_counter() - start
+            except Exception as e:
+                print("error:", e)
+                self.unanswered_chat(users)
+                return
+
+        if self.chat_preempted.is_set():
+            # the host spoke, the comments are dropped from the histories of the viewers so that a user message stays followed by its answer
+            self.unanswered_chat(users)
+            self.drop_chat(len(users))
+            return
+
+        generated = out[:, inputs["input_ids"].shape[1] :]
+        tracing.metrics.observe("llm_chat_batch_size", len(users), model="phi4")
+        tracing.metrics.observe("llm_tokens_per_second", (generated != self.tokenizer.pad_token_id).sum().item() / elapsed, model="phi4", task="chat")
+        for user, text in zip(users, self.tokenizer.batch_decode(generated, skip_special_tokens=True)):
+            text = text.strip()
+            history = self.history_chat[user]
+            history.append({"role": "assistant", "content": text})
+            del history[1 : max(len(history) - 2 * self.chat_history_size, 1)]
+            yield (answers[user], MessageType.TEXT, text)
+
+    def unanswered_chat(self, users: list[str]) -> None:
+        for user in users:
+            self.history_chat[user].pop()
+
+    def process_chat(self, type: MessageType, content: Any) -> Iterator[tuple[MessageType, Any]]:
+        for _, result_type, result in self.process_chat_batch([(type, content)]):
+            yield (result_type, result)
+
+
+@dataclass
+class AudioClip:
+    # features of a clip as computed by the audio feature extractor, unpadded, and the number of tokens it takes in the prompt
+    features: torch.Tensor
+    frames: int
+    embed_size: int
+
+    @property
+    def nbytes(self) -> int:
+        return self.features.element_size() * self.features.numel()
 
 
 class Phi4Multimodal(Phi4):
@@ -116,43 +684,148 @@ class Phi4Multimodal(Phi4):
         model_path: str = "Lexius/Phi-4-multimodal-instruct",
         system_prompt_host: str = "",
         system_prompt_chat: str = "",
+        max_new_tokens: int = 512,
         context_size_limit: int = -1,
         system_prompt_summary: str = "",
         device: str = "auto",
+        **kwargs: Any,
     ) -> None:
-        Phi4.__init__(self, model_path, system_prompt_host, system_prompt_chat, context_size_limit, system_prompt_summary, device)
+        # the prefix cache is computed from the text tokens only, it does not hold for prompts with audio
+        kwargs.setdefault("reuse_cache", False)
+        Phi4.__init__(
+            self,
+            model_path,
+            system_prompt_host=system_prompt_host,
+            system_prompt_chat=system_prompt_chat,
+            max_new_tokens=max_new_tokens,
+            context_size_limit=context_size_limit,
+            system_prompt_summary=system_prompt_summary,
+            device=device,
+            **kwargs,
+        )
         self.processor = AutoProcessor.from_pretrained(model_path, trust_remote_code=True, use_fast=True)
-        self.audios: list[tuple[np.ndarray, int]] = []
+        # the frames of a cached clip are counted from its features, they make the attention mask of a prompt with several clips
+        self.audio_feat_stride = getattr(self.processor.audio_processor, "audio_feat_stride", None)
+        if self.audio_feat_stride is None:
+            raise ValueError(f"the audio processor of {model_path} has no audio_feat_stride, the audio features can not be cached")
+
+    def start_conversation(self, system_prompt_host: str, system_prompt_chat: str, snapshot_path: str | None, snapshot_interval: float) -> None:
+        # the features of a clip are extracted once, when it is heard, and dropped with the last message that refers to it:
+        # the history refers to the clips by a number that never changes, they are numbered from 1 again in each prompt
+        self.clips: dict[int, AudioClip] = {}
+        self.next_clip = 1
+        Phi4.start_conversation(self, system_prompt_host, system_prompt_chat, snapshot_path, snapshot_interval)
+
+    def add_clip(self, audio: tuple[np.ndarray, int]) -> int:
+        extractor = self.processor.audio_processor
+        features = extractor([audio], return_tensors="pt")
+        embeds = features["input_audio_embeds"][0]
+        clip = self.next_clip
+        self.next_clip += 1
+        self.clips[clip] = AudioClip(embeds, len(embeds) * self.audio_feat_stride, int(features["audio_embed_sizes"][0]))
+        self.observe_memory()
+        return clip
+
+    def evict_clips(self) -> None:
+        referenced = {int(clip) for message in self.history_host for clip in AUDIO_PLACEHOLDER.findall(message["content"])}
+        evicted = [clip for clip in self.clips if clip not in referenced]
+        for clip in evicted:
+            del self.clips[clip]
+        if evicted:
+            self.observe_memory()
+            tqdm.tqdm.write(f"[phi4] {len(evicted)} audio clips dropped, {len(self.clips)} kept ({self.audio_memory() / 2**20:.1f} MiB)")
+
+    def audio_memory(self) -> int:
+        # the audio itself is not kept once its features are extracted
+        return sum(clip.nbytes for clip in self.clips.values())
+
+    def observe_memory(self) -> None:
+        tracing.metrics.observe("llm_audio_clips", len(self.clips), model="phi4")
+        tracing.metrics.observe("llm_audio_features_bytes", self.audio_memory(), model="phi4")
+
+    def snapshot_state(self) -> dict[str, Any]:
+        state = Phi4.snapshot_state(self)
+        state["clips"] = [(clip, audio.features, audio.frames, audio.embed_size) for clip, audio in self.clips.items()]
+        state["next_clip"] = self.next_clip
+        return state
 
-    def process_host(self, type: MessageType, content: Any) -> list[tuple[MessageType, Any]]:
+    def restore_state(self, state: dict[str, Any]) -> None:
+        # the clips first, the history then drops those it no longer refers to
+        self.clips = {clip: AudioClip(features, frames, embed_size) for clip, features, frames, embed_size in state.get("clips", [])}
+        self.next_clip = state.get("next_clip", 1)
+        Phi4.restore_state(self, state)
+        self.observe_memory()
+
+    def replace_host(self, history: list[dict[str, str]], tokens: list[int]) -> None:
+        # a compaction or a reset drops the clips of the messages it removed
+        Phi4.replace_host(self, history, tokens)
+        self.evict_clips()
+
+    def chat_inputs(self, history: list[dict[str, str]]) -> BatchEncoding:
+        text = self.tokenizer.apply_chat_template(history, add_generation_prompt=True, tokenize=False)
+        order = list(dict.fromkeys(int(clip) for clip in AUDIO_PLACEHOLDER.findall(text)))
+        if not order:
+            return self.processor(text=text, return_tensors="pt").to(self.model.device)
+
+        # the processor is given the placeholders already expanded into the tokens of their clip, and the cached features are
+        # batched the way the feature extractor does it
+        text = AUDIO_PLACEHOLDER.sub(lambda match: AUDIO_TOKEN * self.clips[int(match.group(1))].embed_size, text)
+        inputs = self.processor(text=text, return_tensors="pt")
+        clips = [self.clips[clip] for clip in order]
+        frames = torch.tensor([clip.frames for clip in clips])
+        audio = {
+            "input_audio_embeds": pad_sequence([clip.features for clip in clips], batch_first=True),
+            "audio_embed_sizes": torch.tensor([clip.embed_size for clip in clips]),
+        }
+        if len(clips) > 1:
+            audio["audio_attention_mask"] = torch.arange(0, int(frames.max())).unsqueeze(0) < frames.unsqueeze(1)
+        inputs.update(audio, input_mode=torch.tensor([SPEECH_MODE]))
+        return inputs.to(self.model.device)
+
+    def reply_host(self, type: MessageType, content: Any) -> Iterator[tuple[MessageType, Any]]:
+        if type not in (MessageType.AUDIO, MessageType.TEXT):
+            return
+
+        self.cancel_compaction()
+        self.interrupted.clear()
+        with self.lock:
+            self.spoken = []
+            self.unspoken = 0
+            trace = tracing.current()
+            self.reply_trace = trace.id if trace is not None else None
         match type:
             case MessageType.AUDIO:
-                self.audios.append(content)
-                self.history_host.append({"role": "user", "content": f"<|audio_{len(self.audios)}|>"})
+                clip = self.add_clip(content)
+                self.append_host("user", f"<|audio_{clip}|>")
+                # the placeholder stands for as many tokens as the clip has embeddings
+                self.history_host_tokens[-1] += self.clips[clip].embed_size
+                self.history_host_size += self.clips[clip].embed_size
             case MessageType.TEXT:
-                self.history_host.append({"role": "user", "content": content})
-            case _:
-                return [(MessageType.NONE, None)]
+                self.append_host("user", content)
 
         try:
             with torch.inference_mode():
-                text = self.tokenizer.apply_chat_template(self.history_host, add_generation_prompt=True, tokenize=False)
-                if self.audios:
-                    inputs = self.processor(text=text, audios=self.audios, return_tensors="pt").to(self.model.device)
-                else:
-                    inputs = self.processor(text=text, return_tensors="pt").to(self.model.device)
-
-                streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
-                streamer_thread = threading.Thread(target=Phi4.progress, args=(streamer, "Generating", 512))
-                streamer_thread.start()
-                out = self.model.generate(
-                    **inputs, max_new_tokens=512, generation_config=self.generation_config, do_sample=True, temperature=0.7, streamer=streamer
-                )
-                streamer_thread.join()
-                text = self.tokenizer.decode(out[0][len(inputs["input_ids"][0]) :], skip_special_tokens=True)
+                if self.context_size_limit > 0 and self.history_host_size + self.generation_prompt_tokens > self.context_size_limit:
+                    self.replace_host(*self.compacted_history(self.history_host, self.history_host_tokens))
+                inputs = self.chat_inputs(self.history_host)
+
+            reply: list[str] = []
+            stopping_criteria = StoppingCriteriaList([EventStoppingCriteria(self.interrupted)])
+            for sentence in self.stream_sentences(
+                inputs, "Generating", self.max_new_tokens, reply, stopping_criteria=stopping_criteria, **self.sampling()
+            ):
+                if self.interrupted.is_set():
+                    break
+                yield (MessageType.TEXT, sentence)
         except Exception as e:
             print("error:", e)
-            return [(MessageType.NONE, None)]
+            return
 
-        self.history_host.append({"role": "assistant", "content": text})
-        return [(MessageType.TEXT, text)]
+        text = "".join(reply).strip()
+        with self.lock:
+            self.append_host("assistant", text)
+            self.unspoken += len(WORD_CHARACTER.findall(text))
+            if self.interrupted.is_set():
+                self.truncate_reply()
+        self.start_compaction()
+        self.save_snapshot()
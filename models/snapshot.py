@@ -0,0 +1,71 @@
+import os
+import threading
+import time
+from typing import Any
+
+import torch
+import tqdm
+import tracing
+
+
+def load_snapshot(path: str) -> dict[str, Any] | None:
+    # the tensors are memory-mapped, copy-on-write, so that they are only read from disk when used
+    try:
+        return torch.load(path, mmap=True, weights_only=True)
+    except FileNotFoundError:
+        return None
+
+
+class SnapshotWriter:
+    # the state is written by a background thread, aside and renamed so that a reader never sees a partial file,
+    # a state that is not written yet is replaced by a newer one
+    def __init__(self, name: str, path: str, interval: float = 30.0) -> None:
+        self.name = name
+        self.path = path
+        self.interval = interval
+        self.last = time.monotonic()
+        self.pending: dict[str, Any] | None = None
+        self.writing = False
+        self.condition = threading.Condition()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.thread = threading.Thread(target=self.run, name=f"{name}_snapshot", daemon=True)
+        self.thread.start()
+
+    @property
+    def due(self) -> bool:
+        return time.monotonic() - self.last >= self.interval
+
+    def save(self, state: dict[str, Any]) -> None:
+        with self.condition:
+            self.pending = state
+            self.last = time.monotonic()
+            self.condition.notify_all()
+
+    def flush(self, timeout: float | None = None) -> bool:
+        with self.condition:
+            return self.condition.wait_for(lambda: self.pending is None and not self.writing, timeout)
+
+    def run(self) -> None:
+        # on Linux the priority of a thread is its own, the writer gives way to the generation
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending is not None)
+                state, self.pending = self.pending, None
+                self.writing = True
+
+            start = time.perf_counter()
+            try:
+                torch.save(state, self.path + ".tmp")
+                os.replace(self.path + ".tmp", self.path)
+                tracing.metrics.observe("snapshot_write_seconds", time.perf_counter() - start, snapshot=self.name)
+            except Exception as e:
+                tqdm.tqdm.write(f"[{self.name}] snapshot error: {e}")
+            finally:
+                with self.condition:
+                    self.writing = False
+                    self.condition.notify_all()
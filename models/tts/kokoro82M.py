@@ -1,23 +1,123 @@
+import copy
+import os
+import threading
+import time
+import unicodedata
+from collections.abc import Iterable, Iterator
 from typing import Any
 
+import numpy as np
 import torch
+import tqdm
+import tracing
 from kokoro import KPipeline
 from messaging import MessageType
+from models.cache import ArrayStore, JsonStore, LRUCache
+
+
+def normalize(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFC", text).split())
 
 
 class Kokoro82M:
-    def __init__(self, voice: str, device: str = "cpu") -> None:
+    def __init__(
+        self,
+        voice: str,
+        device: str = "cpu",
+        speed: float = 1.0,
+        phoneme_cache_size: int = 4096,
+        audio_cache_size: int = 256 << 20,
+        cache_dir: str | None = None,
+        disk_phoneme_entries: int = 65536,
+        disk_audio_size: int = 1 << 30,
+        prewarm: Iterable[str] = (),
+    ) -> None:
         self.pipeline = KPipeline(lang_code="f", device=device)
+        # the G2P is run on its own so that its result is cached apart from the synthesis
+        self.g2p = KPipeline(lang_code="f", model=False)
         self.voice = voice
+        self.speed = speed
+        self.interrupted = threading.Event()
 
-    def transcribe(self, type: MessageType, content: Any) -> list[tuple[MessageType, Any]]:
-        if type != MessageType.TEXT:
-            return []
+        # normalized text -> phonemes of its segments, and (phonemes, voice, speed) -> audio bounded in bytes,
+        # both are backed by files in `cache_dir` if given so that they survive restarts, bounded in entries and in bytes
+        self.phoneme_cache = LRUCache("kokoro_phonemes", phoneme_cache_size)
+        self.audio_cache = LRUCache("kokoro_audio", audio_cache_size, weight=lambda audio: audio.nbytes)
+        self.phoneme_store = (
+            JsonStore("kokoro_phonemes_disk", os.path.join(cache_dir, "phonemes.jsonl"), disk_phoneme_entries) if cache_dir is not None else None
+        )
+        self.audio_store = (
+            ArrayStore("kokoro_audio_disk", os.path.join(cache_dir, "audio"), disk_audio_size) if cache_dir is not None else None
+        )
 
-        result = []
+        # `prewarm` may be an iterator, which is true even when empty
+        prewarmed = 0
+        for text in prewarm:
+            for _ in self.synthesize(text):
+                pass
+            prewarmed += 1
+        if prewarmed:
+            tqdm.tqdm.write(f"[kokoro] cache prewarmed with {len(self.phoneme_cache.entries)} phrases")
+
+    def session(self, voice: str | None = None, speed: float | None = None) -> "Kokoro82M":
+        # shares the pipelines and the caches, whose audio keys include the voice and the speed
+        session = copy.copy(self)
+        session.voice = self.voice if voice is None else voice
+        session.speed = self.speed if speed is None else speed
+        session.interrupted = threading.Event()
+        return session
+
+    def warmup(self) -> None:
+        # straight through the pipeline, the caches are left untouched
         with torch.inference_mode():
-            for gs, ps, audio in self.pipeline(content, voice=self.voice):
-                result.append((MessageType.TEXT, gs))
-                result.append((MessageType.AUDIO, (audio, 24000)))
+            for _ in self.pipeline("Bonjour à tous.", voice=self.voice, speed=self.speed):
+                pass
+
+    def interrupt(self) -> None:
+        self.interrupted.set()
+
+    def phonemes(self, text: str) -> list[tuple[str, str]]:
+        text = normalize(text)
+        segments = self.phoneme_cache.get(text)
+        if segments is None and self.phoneme_store is not None and (stored := self.phoneme_store.get(text)) is not None:
+            segments = [tuple(segment) for segment in stored]
+        if segments is None:
+            segments = [(gs, ps) for gs, ps, _ in self.g2p(text) if ps]
+            if self.phoneme_store is not None:
+                self.phoneme_store.put(text, segments)
+        self.phoneme_cache.put(text, segments)
+        return segments
+
+    def audio(self, phonemes: str) -> np.ndarray:
+        key = (phonemes, self.voice, self.speed)
+        audio = self.audio_cache.get(key)
+        if audio is None and self.audio_store is not None:
+            audio = self.audio_store.get("\0".join(map(str, key)))
+        if audio is None:
+            with torch.inference_mode():
+                audio = np.concatenate(
+                    [result.audio.numpy() for result in self.pipeline.generate_from_tokens(phonemes, voice=self.voice, speed=self.speed)]
+                )
+            if self.audio_store is not None:
+                self.audio_store.put("\0".join(map(str, key)), audio)
+        self.audio_cache.put(key, audio)
+        return audio
+
+    def synthesize(self, text: str) -> Iterator[tuple[str, np.ndarray]]:
+        for gs, ps in self.phonemes(text):
+            yield gs, self.audio(ps)
+
+    def transcribe(self, type: MessageType, content: Any) -> Iterator[tuple[MessageType, Any]]:
+        if type != MessageType.TEXT:
+            return
 
-        return result
+        # each segment is forwarded as soon as it is synthesized, an interruption stops the synthesis at the next segment
+        self.interrupted.clear()
+        start = time.perf_counter()
+        for gs, audio in self.synthesize(content):
+            if self.interrupted.is_set():
+                return
+            tracing.metrics.observe("tts_real_time_factor", (time.perf_counter() - start) * 24000 / max(len(audio), 1), model="kokoro")
+            yield (MessageType.TEXT, gs)
+            yield (MessageType.AUDIO, (audio, 24000))
+            start = time.perf_counter()
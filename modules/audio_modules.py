@@ -1,11 +1,18 @@
+import queue
+import threading
 import time
+from collections import deque
+from collections.abc import Callable
 from enum import IntEnum, auto, unique
+from typing import Any
 
 import keyboard
 import numpy as np
 import sounddevice as sd
 import tqdm
-from messaging import MessageType, Sink, Source
+import tracing
+from messaging import Message, MessageType, Sink, Source
+from modules.audio_utils import resample
 from modules.module import Module
 
 
@@ -26,74 +33,344 @@ class InputDevice(Module, Source):
         silence_max_duration: float = 1.0,
         key_record: str = "²",
         key_mode_switch: str = "$",
+        streaming: bool = False,
+        stream_chunk_duration: float = 0.5,
+        preroll_duration: float = 0.3,
+        buffer_duration: float = 60.0,
+        barge_in_duration: float = 0.3,
+        min_voice_duration: float = 0.1,
+        device: int | str | None = None,
     ) -> None:
         Module.__init__(self, name=name)
         Source.__init__(self, name=name)
+        self.device = device
         self.samplerate = samplerate
         self.channels = channels
         self.blocksize = blocksize
         self.silence_threshold_db = silence_threshold_db
         self.key_record = key_record
         self.key_mode_switch = key_mode_switch
+        self.interrupt_callbacks: list[Callable[[], None]] = []
 
         self.mode = InputDeviceMode.KEY
-        self.max_silence_chunks = int(silence_max_duration * samplerate / blocksize)
-        self.blocks_since_silence = self.max_silence_chunks
-        self.buffer = []
+        self.max_silence_samples = int(silence_max_duration * samplerate)
+        # mean(x**2) is compared to the threshold directly instead of computing 20 * log10(sqrt(mean(x**2))) for every block
+        self.energy_threshold = 10 ** (silence_threshold_db / 10)
+        self.preroll = int(preroll_duration * samplerate)
+        # the interrupt callbacks are called once per utterance, when its voiced blocks add up to long enough not to be a noise,
+        # an utterance with less than `min_voice_duration` of voice is a click or a bump and it is not sent
+        self.barge_in = int(barge_in_duration * samplerate)
+        self.min_voice = int(min_voice_duration * samplerate)
+        # in streaming mode the utterance is sent as (chunk, samplerate, is_final, device name) while it is recorded, the name keeps
+        # the streams of several devices apart in the ASR
+        self.streaming = streaming
+        self.stream_chunk = max(blocksize, int(stream_chunk_duration * samplerate))
+
+        # the audio callback writes into a preallocated ring buffer, positions are absolute sample counts
+        self.ring = np.zeros((int(buffer_duration * samplerate) // blocksize * blocksize, channels), dtype=np.float32)
+        self.written = 0
+        self.blocks: queue.SimpleQueue[int | None] = queue.SimpleQueue()
+        self.overflows = 0
+        self.key_pressed = False
+        self.last_mode_switch = 0.0
+
+        self.processed = 0
+        self.utterance_start: int | None = None
+        self.utterance_trace: tracing.Trace | None = None
+        self.utterance_voiced = 0
+        self.utterance_sent = 0
+        self.barged_in = False
+        self.last_voice = -self.max_silence_samples
+        self.last_utterance_end = 0
+
+    def register_interrupt(self, callback: Callable[[], None]) -> None:
+        self.interrupt_callbacks.append(callback)
+
+    def interrupt(self) -> None:
+        tqdm.tqdm.write(f"[{self.name}] barge-in")
+        for callback in self.interrupt_callbacks:
+            try:
+                callback()
+            except Exception as e:
+                tqdm.tqdm.write(f"[{self.name}] error: {e}")
+
+    def callback(self, indata: np.ndarray, frames: int, time_info: Any, status: sd.CallbackFlags) -> None:
+        if status.input_overflow:
+            self.overflows += 1
+
+        position = self.written % len(self.ring)
+        head = min(frames, len(self.ring) - position)
+        self.ring[position : position + head] = indata[:head]
+        self.ring[: frames - head] = indata[head:]
+        self.written += frames
+        self.blocks.put(self.written)
+
+    def unblock(self) -> None:
+        self.blocks.put(None)
+
+    def read(self, start: int, end: int) -> np.ndarray:
+        # a single copy out of the ring buffer, the ring is overwritten later so views can not be handed downstream
+        first, last = start % len(self.ring), end % len(self.ring)
+        if first < last or end == start:
+            audio = self.ring[first:last].copy()
+        else:
+            audio = np.concatenate((self.ring[first:], self.ring[:last]))
+        return audio[:, 0] if self.channels == 1 else audio
+
+    def on_key_record(self, event: keyboard.KeyboardEvent) -> None:
+        self.key_pressed = event.event_type == keyboard.KEY_DOWN
+
+    def on_key_mode_switch(self, event: keyboard.KeyboardEvent) -> None:
+        now = time.time()
+        if now - self.last_mode_switch > 0.5:  # debounce
+            self.mode = InputDeviceMode.THRESHOLD if self.mode == InputDeviceMode.KEY else InputDeviceMode.KEY
+            tqdm.tqdm.write(f"[{self.name}] Mode switched to {'threshold' if self.mode == InputDeviceMode.THRESHOLD else 'key'}")
+            self.last_mode_switch = now
+
+    def is_voice(self, start: int, end: int) -> bool:
+        first = start % len(self.ring)
+        block = self.ring[first : first + end - start] if first + end - start <= len(self.ring) else self.read(start, end)
+        return np.vdot(block, block) > self.energy_threshold * block.size
+
+    def send_utterance(self, end: int, final: bool) -> None:
+        if final and self.utterance_voiced < self.min_voice and self.utterance_sent == self.utterance_start:
+            tqdm.tqdm.write(f"[{self.name}] noise of {self.utterance_voiced / self.samplerate:.2f}s ignored")
+            self.utterance_start = None
+            self.utterance_trace = None
+            return
+
+        if final:
+            # the end of speech is the last voiced block, not the end of the silence that closed the utterance
+            voiced = self.last_voice if self.mode == InputDeviceMode.THRESHOLD else end
+            self.utterance_trace.end_of_speech = time.time() - max(0, self.written - voiced) / self.samplerate
+        with tracing.use(self.utterance_trace):
+            self.send_audio(end, final)
+
+        if final:
+            self.utterance_start = None
+            self.utterance_trace = None
+            self.last_utterance_end = end
+
+    def send_audio(self, end: int, final: bool) -> None:
+        if self.streaming:
+            self.send_message(message_type=MessageType.AUDIO, content=(self.read(self.utterance_sent, end), self.samplerate, final, self.name))
+            self.utterance_sent = end
+        elif final:
+            audio_data = self.read(self.utterance_start, end)
+            tqdm.tqdm.write(f"[{self.name}] utterance of {len(audio_data) / self.samplerate:.2f}s")
+            self.send_message(message_type=MessageType.AUDIO, content=(audio_data, self.samplerate))
+
+    def process_block(self, end: int) -> None:
+        start, self.processed = self.processed, end
+        if self.mode == InputDeviceMode.KEY:
+            recording = voiced = self.key_pressed
+        else:
+            voiced = self.is_voice(start, end)
+            if voiced:
+                self.last_voice = end
+            recording = end - self.last_voice < self.max_silence_samples
+
+        if recording and self.utterance_start is None:
+            # the pre-roll keeps the onset that was under the threshold or before the key press
+            self.utterance_start = max(start - self.preroll, self.last_utterance_end, self.written - len(self.ring) + self.blocksize, 0)
+            self.utterance_sent = self.utterance_start
+            self.utterance_trace = tracing.Trace(speaker=self.name)
+            self.utterance_voiced = 0
+            self.barged_in = False
+
+        if self.utterance_start is None:
+            return
+
+        # the silence that ends an utterance is recorded too, only the voiced blocks count
+        if voiced:
+            self.utterance_voiced += end - start
+        if not self.barged_in and self.utterance_voiced >= self.barge_in:
+            self.barged_in = True
+            # under the trace of the new utterance, so that the sinks drop what belongs to the turns before it
+            with tracing.use(self.utterance_trace):
+                self.interrupt()
+
+        if not recording:
+            self.send_utterance(end, final=True)
+        elif end - self.utterance_start >= len(self.ring) - self.blocksize:
+            # the ring buffer is about to overwrite the beginning of the utterance
+            self.send_utterance(end, final=True)
+        elif self.streaming and self.utterance_voiced >= self.min_voice and end - self.utterance_sent >= self.stream_chunk:
+            self.send_utterance(end, final=False)
 
     def run(self) -> None:
-        print(f"[{self.name}] mode {'threshold' if self.mode == InputDeviceMode.THRESHOLD else 'key'}")
-        last_mode_switch = 0
+        tqdm.tqdm.write(f"[{self.name}] mode {'threshold' if self.mode == InputDeviceMode.THRESHOLD else 'key'}")
+        hooks = [
+            keyboard.hook_key(self.key_record, self.on_key_record),
+            keyboard.on_press_key(self.key_mode_switch, self.on_key_mode_switch),
+        ]
+        overflows = 0
+        try:
+            with sd.InputStream(device=self.device, samplerate=self.samplerate, channels=self.channels, blocksize=self.blocksize, dtype="float32", callback=self.callback):
+                while self.is_running.is_set():
+                    end = self.blocks.get()
+                    if end is None:
+                        continue
 
-        with sd.InputStream(samplerate=self.samplerate, channels=self.channels, blocksize=self.blocksize) as stream:
-            while self.is_running.is_set():
-                # handle mode switch
-                if keyboard.is_pressed(self.key_mode_switch):
-                    now = time.time()
-                    if now - last_mode_switch > 0.5:  # debounce
-                        self.mode = InputDeviceMode.THRESHOLD if self.mode == InputDeviceMode.KEY else InputDeviceMode.KEY
-                        print(f"[{self.name}] Mode switched to {'threshold' if self.mode == InputDeviceMode.THRESHOLD else 'key'}")
-                        last_mode_switch = now
-
-                # read a block
-                block, _ = stream.read(self.blocksize)
-
-                # handle recording
-                if self.mode == InputDeviceMode.KEY and keyboard.is_pressed(self.key_record):
-                    self.buffer.append(block)
-                elif self.mode == InputDeviceMode.THRESHOLD and (
-                    (is_above := 20 * np.log10(np.sqrt(np.mean(block**2))) > self.silence_threshold_db) or self.blocks_since_silence < self.max_silence_chunks
-                ):
-                    self.buffer.append(block)
-                    self.blocks_since_silence = 0 if is_above else (self.blocks_since_silence + 1)
-                elif len(self.buffer) > 0:
-                    audio_data = np.concatenate(self.buffer, axis=0)
-                    audio_data = np.squeeze(audio_data)
-                    print(audio_data.shape)
-                    self.send_message(message_type=MessageType.AUDIO, content=(audio_data, self.samplerate))
-                    self.buffer = []
+                    self.process_block(end)
+                    if self.overflows != overflows:
+                        overflows = self.overflows
+                        tqdm.tqdm.write(f"[{self.name}] input overflow ({overflows})")
+        finally:
+            for hook in hooks:
+                keyboard.unhook(hook)
 
 
 class OutputDevice(Module, Sink):
-    def __init__(self, name: str) -> None:
+    def __init__(
+        self,
+        name: str,
+        samplerate: int | None = None,
+        blocksize: int = 1024,
+        buffer_duration: float = 30.0,
+        device: int | str | None = None,
+        on_spoken: Callable[[str, int | None], None] | None = None,
+    ) -> None:
         Module.__init__(self, name=name)
         Sink.__init__(self, name=name)
+        self.device = device
+        self.samplerate = samplerate or int(sd.query_devices(device, "output")["default_samplerate"])
+        self.blocksize = blocksize
 
-    def run(self) -> None:
-        while self.is_running.is_set():
-            try:
-                _, _, message = self.sink_queue.get(timeout=0.1)
-                if message.producer in self.last_ids:
-                    if message.id < self.last_ids[message.producer]:
-                        tqdm.tqdm.write(f"[{self.name}] drop old message from [{message.producer.name}]")
-                        continue
+        # a single output stream plays from a ring buffer fed by the AUDIO messages, positions are absolute sample counts
+        self.ring = np.zeros(int(buffer_duration * self.samplerate), dtype=np.float32)
+        self.written = 0
+        self.played = 0
+        self.flushed = 0
+        self.flush_count = 0
+        self.writing = False
+        self.underruns = 0
 
-                    self.last_ids[message.producer] = message.id
-            except Exception:
-                continue
+        # TEXT messages precede the AUDIO they were synthesized from, the text is reported once its audio has been played
+        # with the id of the trace of the turn it belongs to, so that the LLM only counts the spoken part of its own reply
+        self.on_spoken = on_spoken
+        self.reading = ""
+        self.segments: deque[tuple[int, str, int | None]] = deque()
+        self.segments_lock = threading.Lock()
+        # the loop sleeps until a message arrives or the audio callback has something to report, the callback only sets an event
+        # which never waits for the loop
+        self.wakeup = threading.Event()
+
+    @property
+    def buffered_duration(self) -> float:
+        return (self.written - self.played) / self.samplerate
+
+    def callback(self, outdata: np.ndarray, frames: int, time_info: Any, status: sd.CallbackFlags) -> None:
+        underruns = self.underruns
+        if status.output_underflow:
+            self.underruns += 1
+
+        if self.flushed > self.played:
+            self.played = self.flushed
+        played = self.played
+
+        available = self.written - self.played
+        count = min(frames, available)
+        position = self.played % len(self.ring)
+        head = min(count, len(self.ring) - position)
+        outdata[:head, 0] = self.ring[position : position + head]
+        outdata[head:count, 0] = self.ring[: count - head]
+        outdata[count:] = 0
+        self.played += count
+        if count < frames and self.writing:
+            # ran dry in the middle of a segment, this is an audible gap
+            self.underruns += 1
+
+        # the loop is woken when a segment has been played or on an underrun
+        try:
+            finished = played < self.segments[0][0] <= self.played
+        except IndexError:
+            finished = False
+        if finished or self.underruns != underruns:
+            self.wakeup.set()
 
-            if message.type != MessageType.AUDIO:
+    def write(self, audio: np.ndarray) -> bool:
+        flush_count = self.flush_count
+        self.writing = True
+        offset = 0
+        while offset < len(audio) and self.is_running.is_set() and flush_count == self.flush_count:
+            count = min(len(self.ring) - (self.written - self.played), len(audio) - offset)
+            if count == 0:
+                time.sleep(self.blocksize / self.samplerate)
                 continue
 
-            sd.play(message.content, samplerate=24000)
-            sd.wait()
+            position = self.written % len(self.ring)
+            head = min(count, len(self.ring) - position)
+            self.ring[position : position + head] = audio[offset : offset + head]
+            self.ring[: count - head] = audio[offset + head : offset + count]
+            self.written += count
+            offset += count
+
+        self.writing = False
+        if flush_count != self.flush_count:
+            # a flush happened while writing, what was written meanwhile is stale too
+            self.flushed = self.written
+            return False
+        return offset == len(audio)
+
+    def flush(self) -> None:
+        with self.segments_lock:
+            self.segments.clear()
+        self.flush_count += 1
+        self.flushed = self.written
+
+    def interrupt(self) -> None:
+        self.supersede()
+        self.flush()
+
+    def receive_message(self, message: Message) -> None:
+        Sink.receive_message(self, message)
+        self.wakeup.set()
+
+    def unblock(self) -> None:
+        Module.unblock(self)
+        self.wakeup.set()
+
+    def report_spoken(self) -> None:
+        with self.segments_lock:
+            while self.segments and self.segments[0][0] <= self.played:
+                _, text, trace_id = self.segments.popleft()
+                if self.on_spoken is not None:
+                    self.on_spoken(text, trace_id)
+
+    def run(self) -> None:
+        underruns = 0
+        with sd.OutputStream(
+            samplerate=self.samplerate, blocksize=self.blocksize, channels=1, dtype="float32", device=self.device, callback=self.callback
+        ):
+            while self.is_running.is_set():
+                self.wakeup.wait()
+                self.wakeup.clear()
+                self.report_spoken()
+                if self.underruns != underruns:
+                    underruns = self.underruns
+                    tqdm.tqdm.write(f"[{self.name}] output underrun ({underruns}), {self.buffered_duration:.2f}s buffered")
+
+                # the messages that arrived are all handled before sleeping again
+                while self.is_running.is_set() and self.sink_queue.qsize():
+                    if (message := self.get_message(timeout=0)) is not None:
+                        self.play(message)
+
+    def play(self, message: Message) -> None:
+        with tracing.span(self.name, message.trace):
+            match message.type:
+                case MessageType.TEXT:
+                    tqdm.tqdm.write(f"(Reading) {message.content}")
+                    self.reading = message.content
+                case MessageType.AUDIO:
+                    trace = message.trace
+                    if trace is not None and trace.end_of_speech is not None and trace.first_audio is None:
+                        # the segment starts playing once what is already buffered has been played
+                        trace.first_audio = time.time() + self.buffered_duration
+                        tracing.metrics.observe("end_of_speech_to_first_audio_seconds", trace.first_audio - trace.end_of_speech, module=self.name)
+
+                    audio = resample(np.asarray(message.content[0], dtype=np.float32).ravel(), message.content[1], self.samplerate)
+                    if self.write(audio):
+                        with self.segments_lock:
+                            self.segments.append((self.written, self.reading, trace.id if trace is not None else None))
+                    self.reading = ""
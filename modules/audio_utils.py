@@ -0,0 +1,41 @@
+import wave
+
+import numpy as np
+
+
+def resample(audio: np.ndarray, samplerate_in: int, samplerate_out: int) -> np.ndarray:
+    if samplerate_in == samplerate_out:
+        return audio
+    # linear interpolation is enough for speech
+    length = int(round(len(audio) * samplerate_out / samplerate_in))
+    return np.interp(np.arange(length) * (samplerate_in / samplerate_out), np.arange(len(audio)), audio).astype(np.float32)
+
+
+def read_wav(path: str, samplerate: int | None = None) -> tuple[np.ndarray, int]:
+    # PCM wav to mono float32 in [-1, 1], resampled to `samplerate` if given
+    with wave.open(path, "rb") as f:
+        width, channels, rate = f.getsampwidth(), f.getnchannels(), f.getframerate()
+        frames = f.readframes(f.getnframes())
+
+    match width:
+        case 1:
+            audio = (np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128) / 128
+        case 2:
+            audio = np.frombuffer(frames, dtype="<i2").astype(np.float32) / 32768
+        case 4:
+            audio = np.frombuffer(frames, dtype="<i4").astype(np.float32) / 2147483648
+        case _:
+            raise ValueError(f"unsupported sample width {width} in {path}")
+
+    audio = audio.reshape(-1, channels).mean(axis=1)
+    if samplerate is not None and samplerate != rate:
+        return resample(audio, rate, samplerate), samplerate
+    return audio, rate
+
+
+def write_wav(path: str, audio: np.ndarray, samplerate: int) -> None:
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(samplerate)
+        f.writeframes((np.clip(audio, -1, 1) * 32767).astype("<i2").tobytes())
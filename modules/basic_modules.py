@@ -1,36 +1,42 @@
+import threading
+import time
 from collections import defaultdict
-from collections.abc import Callable
+from collections.abc import Callable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
 from typing import Any
 
 import tqdm
-from messaging import Message, MessageType, Producer, Sink, Source
+import tracing
+from messaging import BatchTransform, Message, MessageType, Producer, Sink, Source, Transform
 from modules.module import Module
 
 
 class BasicSink(Module, Sink):
-    def __init__(self, name: str, transform: Callable[[MessageType, Any], None]) -> None:
+    def __init__(self, name: str, transform: Callable[[MessageType, Any], Iterator[Any] | None]) -> None:
         Module.__init__(self, name=name)
         Sink.__init__(self, name=name)
         self.transform = transform
 
     def run(self) -> None:
         while self.is_running.is_set():
-            try:
-                _, _, message = self.sink_queue.get(timeout=0.1)
-                if message.producer in self.last_ids:
-                    if message.id < self.last_ids[message.producer]:
-                        tqdm.tqdm.write(f"[{self.name}] drop old message from [{message.producer.name}]")
-                        continue
-
-                    self.last_ids[message.producer] = message.id
-            except Exception:
+            message = self.get_message()
+            if message is None:
                 continue
 
-            self.transform(message.type, message.content)
+            try:
+                # a generator transform, like those of a process module or a model server, only runs when iterated
+                with tracing.span(self.name, message.trace):
+                    result = self.transform(message.type, message.content)
+                    if isinstance(result, Iterator):
+                        for _ in result:
+                            pass
+            except Exception as e:
+                tqdm.tqdm.write(f"[{self.name}] error: {e}")
 
 
 class BasicProxy(Module, Sink, Source):
-    def __init__(self, name: str, transform: Callable[[MessageType, Any], list[tuple[MessageType, Any]]], priority: int = 0) -> None:
+    def __init__(self, name: str, transform: Transform, priority: int = 0) -> None:
         Module.__init__(self, name=name)
         Sink.__init__(self, name=name)
         Source.__init__(self, name=name, priority=priority)
@@ -38,19 +44,79 @@ class BasicProxy(Module, Sink, Source):
 
     def run(self) -> None:
         while self.is_running.is_set():
+            message = self.get_message()
+            if message is None:
+                continue
+
             try:
-                _, _, message = self.sink_queue.get(timeout=0.1)
-                if message.producer in self.last_ids:
-                    if message.id < self.last_ids[message.producer]:
-                        tqdm.tqdm.write(f"[{self.name}] drop old message from [{message.producer.name}]")
-                        continue
-
-                    self.last_ids[message.producer] = message.id
-            except Exception:
+                # results are sent as soon as they are produced, so a generator transform streams to the next module
+                with tracing.span(self.name, message.trace):
+                    for type, content in self.transform(message.type, message.content):
+                        if type != MessageType.NONE:
+                            self.send_message(type, content)
+            except Exception as e:
+                tqdm.tqdm.write(f"[{self.name}] error: {e}")
+
+
+class BatchProxy(Module, Sink, Source):
+    # gathers up to `max_batch_size` messages, waiting at most `max_wait` after the first one, and transforms them together,
+    # messages arriving while a batch is processed make up the next one, with a `max_wait` of 0 the batch is what was queued
+    def __init__(
+        self, name: str, transform: BatchTransform, max_batch_size: int = 8, max_wait: float = 0.05, priority: int = 0, per_producer: bool = False
+    ) -> None:
+        Module.__init__(self, name=name)
+        Sink.__init__(self, name=name)
+        Source.__init__(self, name=name, priority=priority)
+        self.transform = transform
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        # with `per_producer`, the outputs are sent by a distinct producer for each input producer, so that a broker can route them by origin
+        self.per_producer = per_producer
+        self.producers: dict[Producer, Source] = {}
+
+    def producer_for(self, producer: Producer) -> Source:
+        if producer not in self.producers:
+            source = Source(name=f"{self.name}[{producer.name}]", priority=self.priority)
+            # the sinks registered on the proxy are shared by all its producers
+            source.sinks = self.sinks
+            self.producers[producer] = source
+        return self.producers[producer]
+
+    def get_batch(self) -> list[Message]:
+        message = self.get_message()
+        if message is None:
+            return []
+
+        batch = [message]
+        deadline = time.perf_counter() + self.max_wait
+        # once `max_wait` is over, the messages already queued still join the batch
+        while len(batch) < self.max_batch_size:
+            remaining = max(deadline - time.perf_counter(), 0.0)
+            if (message := self.get_message(timeout=remaining)) is not None:
+                batch.append(message)
+            elif remaining == 0:
+                break
+        return batch
+
+    def run(self) -> None:
+        while self.is_running.is_set():
+            batch = self.get_batch()
+            if not batch:
                 continue
 
-            for type, content in self.transform(message.type, message.content):
-                self.send_message(type, content)
+            try:
+                tracing.metrics.observe("batch_size", len(batch), module=self.name)
+                with tracing.span(self.name, batch[0].trace):
+                    for i, type, content in self.transform([(message.type, message.content) for message in batch]):
+                        if type != MessageType.NONE:
+                            # each output carries the trace of the message it answers
+                            with tracing.use(batch[i].trace):
+                                if self.per_producer:
+                                    self.producer_for(batch[i].producer).send_message(type, content)
+                                else:
+                                    self.send_message(type, content)
+            except Exception as e:
+                tqdm.tqdm.write(f"[{self.name}] error: {e}")
 
 
 class BasicBroker(Module, Sink, Producer):
@@ -58,22 +124,157 @@ class BasicBroker(Module, Sink, Producer):
         Module.__init__(self, name=name)
         Sink.__init__(self, name=name)
         Producer.__init__(self, name=name, priority=priority)
-        self.sinks: dict[Producer, dict[Sink, Callable[[MessageType, Any], list[tuple[MessageType, Any]]]]] = defaultdict(dict)
+        self.sinks: dict[Producer, dict[Sink, Transform]] = defaultdict(dict)
+        self.errors: dict[tuple[Producer, Sink], int] = defaultdict(int)
+        # called as soon as a message arrives, before it waits in the queue, so that lower priority work on a shared model gives way
+        self.preempt_callbacks: list[Callable[[], None]] = []
 
-    def register_route(self, source: Producer, sink: Sink, transform: Callable[[MessageType, Any], list[tuple[MessageType, Any]]]) -> None:
+    def register_route(self, source: Producer, sink: Sink, transform: Transform) -> None:
         self.sinks[source][sink] = transform
 
+    def register_preempt(self, callback: Callable[[], None]) -> None:
+        self.preempt_callbacks.append(callback)
+
+    def receive_message(self, message: Message) -> None:
+        for callback in self.preempt_callbacks:
+            callback()
+        Sink.receive_message(self, message)
+
     def unregister_route(self, source: Producer, sink: Sink) -> None:
         self.sinks[source].pop(sink, None)
 
+    def process(self, message: Message, sink: Sink, transform: Transform) -> bool:
+        # a failing route does not prevent the others from running, its errors are counted and reported
+        start = time.perf_counter()
+        try:
+            for type, content in transform(message.type, message.content):
+                if type != MessageType.NONE:
+                    sink.receive_message(Message(self, self.new_message_id(), type, content))
+        except Exception as e:
+            self.errors[(message.producer, sink)] += 1
+            tqdm.tqdm.write(f"[{self.name}] error on route [{message.producer.name}] -> [{sink.name}]: {e}")
+            outcome = "error"
+        else:
+            outcome = "ok"
+        route = f"{message.producer.name}->{sink.name}"
+        tracing.metrics.observe("broker_route_seconds", time.perf_counter() - start, module=self.name, route=route, outcome=outcome)
+        return outcome == "ok"
+
     def run(self) -> None:
         while self.is_running.is_set():
-            try:
-                _, _, message = self.sink_queue.get(timeout=0.1)
-                for sink in self.sinks[message.producer]:
-                    result = self.sinks[message.producer][sink](message.type, message.content)
-                    for type, content in result:
-                        if type != MessageType.NONE:
-                            sink.receive_message(Message(self, next(self.msg_counter), type, content))
-            except Exception:
+            message = self.get_message()
+            if message is None:
                 continue
+
+            with tracing.span(self.name, message.trace):
+                for sink, transform in list(self.sinks[message.producer].items()):
+                    self.process(message, sink, transform)
+
+
+@dataclass
+class Route:
+    executor: ThreadPoolExecutor
+    max_in_flight: int | None
+    ordered: bool
+    blocking: bool = False
+    in_flight: int = 0
+    dropped: int = 0
+    # last task of each producer, the next one waits for it when the route is ordered
+    tails: dict[Producer, Future] = field(default_factory=dict)
+
+
+class ConcurrentBroker(BasicBroker):
+    # every route runs on its own pool of `workers` threads, so that a slow route does not hold back the others,
+    # with `ordered` the messages of a producer go through a route one after the other and their outputs stay in order,
+    # beyond `max_in_flight` messages waiting or running on a route the new ones are dropped for that route, or with `blocking`
+    # the broker waits for room, which holds back its other routes and leaves the messages in its queue
+    def __init__(
+        self, name: str, priority: int = 0, workers: int = 1, max_in_flight: int | None = None, ordered: bool = True, blocking: bool = False
+    ) -> None:
+        BasicBroker.__init__(self, name=name, priority=priority)
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+        self.ordered = ordered
+        self.blocking = blocking
+        self.routes: dict[tuple[Producer, Sink], Route] = {}
+        self.lock = threading.Lock()
+        self.room = threading.Condition(self.lock)
+        self.stopping = False
+
+    def register_route(
+        self,
+        source: Producer,
+        sink: Sink,
+        transform: Transform,
+        workers: int | None = None,
+        max_in_flight: int | None = None,
+        ordered: bool | None = None,
+        blocking: bool | None = None,
+    ) -> None:
+        BasicBroker.register_route(self, source, sink, transform)
+        self.routes[(source, sink)] = Route(
+            ThreadPoolExecutor(max_workers=workers or self.workers, thread_name_prefix=f"{self.name}[{source.name}->{sink.name}]"),
+            max_in_flight if max_in_flight is not None else self.max_in_flight,
+            ordered if ordered is not None else self.ordered,
+            blocking if blocking is not None else self.blocking,
+        )
+
+    def unregister_route(self, source: Producer, sink: Sink) -> None:
+        BasicBroker.unregister_route(self, source, sink)
+        if (route := self.routes.pop((source, sink), None)) is not None:
+            route.executor.shutdown(wait=False, cancel_futures=True)
+
+    def dispatch(self, message: Message, sink: Sink, transform: Transform) -> None:
+        route = self.routes[(message.producer, sink)]
+        with self.lock:
+            if route.blocking and route.max_in_flight is not None:
+                self.room.wait_for(lambda: route.in_flight < route.max_in_flight or self.stopping)
+            if route.max_in_flight is not None and route.in_flight >= route.max_in_flight:
+                # counted apart from the latency of the route
+                route.dropped += 1
+                name = f"{message.producer.name}->{sink.name}"
+                with tracing.use(message.trace):
+                    tracing.metrics.observe("broker_route_drops", 1, module=self.name, route=name)
+                tqdm.tqdm.write(f"[{self.name}] route {name} full, message dropped ({route.dropped} so far)")
+                return
+
+            route.in_flight += 1
+            previous = route.tails.get(message.producer) if route.ordered else None
+            future = route.executor.submit(self.work, message, sink, transform, previous)
+            if route.ordered:
+                route.tails[message.producer] = future
+        future.add_done_callback(lambda future: self.done(route, message.producer, future))
+
+    def work(self, message: Message, sink: Sink, transform: Transform, previous: Future | None) -> None:
+        # the previous task was submitted first, it is already running or it will be before this one
+        if previous is not None:
+            wait([previous])
+        with tracing.use(message.trace):
+            self.process(message, sink, transform)
+
+    def done(self, route: Route, producer: Producer, future: Future) -> None:
+        with self.lock:
+            route.in_flight -= 1
+            if route.tails.get(producer) is future:
+                del route.tails[producer]
+            self.room.notify_all()
+
+    def run(self) -> None:
+        with self.lock:
+            self.stopping = False
+        while self.is_running.is_set():
+            message = self.get_message()
+            if message is None:
+                continue
+
+            for sink, transform in list(self.sinks[message.producer].items()):
+                self.dispatch(message, sink, transform)
+
+    def stop(self) -> None:
+        # a dispatch waiting for room on a blocking route is released first
+        with self.lock:
+            self.stopping = True
+            self.room.notify_all()
+        BasicBroker.stop(self)
+        for route in self.routes.values():
+            route.executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,37 @@
+import time
+from collections.abc import Iterable
+from typing import Any
+
+import numpy as np
+import tqdm
+from messaging import MessageType, Source
+from modules.module import Module
+
+
+class ChatFeed(Module, Source):
+    # stands in for the chat of a stream, sends "user: comment" lines as TEXT at `rate` comments per second on average
+    def __init__(self, name: str, comments: Iterable[str], rate: float = 1.0, loop: bool = False, priority: int = 1, seed: int | None = None) -> None:
+        Module.__init__(self, name=name)
+        Source.__init__(self, name=name, priority=priority)
+        self.comments = [comment.strip() for comment in comments if ":" in comment]
+        self.rate = rate
+        self.loop = loop
+        self.rng = np.random.default_rng(seed)
+
+    @classmethod
+    def from_file(cls, name: str, path: str, **kwargs: Any) -> "ChatFeed":
+        with open(path, encoding="utf-8") as f:
+            return cls(name, f.readlines(), **kwargs)
+
+    def run(self) -> None:
+        while self.is_running.is_set():
+            for comment in self.comments:
+                # comments arrive as a poisson process
+                time.sleep(self.rng.exponential(1 / self.rate))
+                if not self.is_running.is_set():
+                    return
+                self.send_message(MessageType.TEXT, comment)
+
+            if not self.loop:
+                tqdm.tqdm.write(f"[{self.name}] all comments sent.")
+                break
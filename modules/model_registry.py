@@ -0,0 +1,48 @@
+import os
+from collections.abc import Callable
+from typing import Any
+
+from modules.process_module import ProcessModule
+
+
+class ModelRegistry:
+    # the models are loaded and warmed up concurrently, each in its own process, while the pipeline is already running:
+    # a call to a model that is not ready yet waits for it
+    def __init__(self, compile_cache_dir: str | None = "cache/inductor") -> None:
+        self.compile_cache_dir = compile_cache_dir
+        self.models: dict[str, ProcessModule] = {}
+
+    def register(self, name: str, factory: Callable[[], Any], **kwargs: Any) -> ProcessModule:
+        self.models[name] = ProcessModule(name, factory, **kwargs)
+        return self.models[name]
+
+    def __getitem__(self, name: str) -> ProcessModule:
+        return self.models[name]
+
+    def start(self) -> None:
+        if self.compile_cache_dir is not None:
+            # the processes inherit the environment, Inductor then keeps its compiled graphs and kernels there between runs
+            os.makedirs(self.compile_cache_dir, exist_ok=True)
+            os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.abspath(self.compile_cache_dir))
+            os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+            os.environ.setdefault("TORCHINDUCTOR_AUTOGRAD_CACHE", "1")
+
+        for model in self.models.values():
+            model.start()
+
+    def stop(self) -> None:
+        for model in self.models.values():
+            model.stop()
+
+    def wait(self, timeout: float | None = None) -> bool:
+        return all(model.ready.wait(timeout) for model in self.models.values())
+
+    def report(self) -> str:
+        lines = [f"{'model':<12} {'spawn (s)':>10} {'load (s)':>9} {'warm-up (s)':>12} {'ready (s)':>10}"]
+        for name, model in self.models.items():
+            if model.timings is None:
+                lines.append(f"{name:<12} {'loading':>10}")
+                continue
+            start, started, loaded, warm = model.timings
+            lines.append(f"{name:<12} {started - start:>10.2f} {loaded - started:>9.2f} {warm - loaded:>12.2f} {warm - start:>10.2f}")
+        return "\n".join(lines)
@@ -0,0 +1,401 @@
+import functools
+import os
+import queue
+import socket
+import threading
+import time
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass, field
+from itertools import count
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Any
+
+import tqdm
+import tracing
+from messaging import BatchTransform, Transform
+from modules.model_registry import ModelRegistry
+from modules.module import Module
+
+# several pipelines share one set of loaded models: the server holds the model processes of a registry, each client connected to its
+# Unix socket is a session with its own state in every model process (history, voice, streaming buffers), see ProcessModule sessions
+# messages from a client: ("open", session, {model: session arguments}), ("call", call_id, model, method, args, priority, trace),
+# ("control", model, method, args) and ("report",), the server answers with (call_id, kind, payload) as a model process does
+
+
+@dataclass
+class Job:
+    session: str
+    priority: int
+    method: str
+    args: tuple
+    trace: tracing.Trace | None
+    reply: Callable[[str, Any], None]
+    sequence: int = 0
+    submitted: float = field(default_factory=time.perf_counter)
+
+
+@dataclass
+class Usage:
+    requests: int = 0
+    busy: float = 0.0
+    wait: float = 0.0
+    # model time the session is credited with, it does not catch up on the time it was idle
+    served: float = 0.0
+    opened: float = field(default_factory=time.perf_counter)
+
+
+class FairScheduler:
+    # the calls to a model go one at a time, the lowest priority value first, then the session that was served the least,
+    # a call runs to its end once started
+    def __init__(self, name: str, call: Callable[..., Iterator[Any]]) -> None:
+        self.name = name
+        self.call = call
+        self.jobs: list[Job] = []
+        self.usage: dict[str, Usage] = {}
+        self.sequence = count()
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name=f"{self.name}_scheduler", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def open(self, session: str) -> None:
+        with self.condition:
+            self.usage[session] = Usage()
+
+    def close(self, session: str) -> None:
+        with self.condition:
+            self.jobs = [job for job in self.jobs if job.session != session]
+            self.usage.pop(session, None)
+
+    def submit(self, job: Job) -> None:
+        with self.condition:
+            usage = self.usage.get(job.session)
+            if usage is not None and not any(queued.session == job.session for queued in self.jobs):
+                # a session that was idle, or that just joined, starts level with the least served of those waiting
+                waiting = [self.usage[queued.session].served for queued in self.jobs if queued.session in self.usage]
+                usage.served = max(usage.served, min(waiting, default=usage.served))
+            job.sequence = next(self.sequence)
+            self.jobs.append(job)
+            self.condition.notify()
+
+    def next_job(self) -> Job | None:
+        with self.condition:
+            self.condition.wait_for(lambda: self.jobs or not self.running)
+            if not self.running:
+                return None
+            job = min(self.jobs, key=lambda job: (job.priority, self.usage[job.session].served if job.session in self.usage else 0.0, job.sequence))
+            self.jobs.remove(job)
+            return job
+
+    def run(self) -> None:
+        while (job := self.next_job()) is not None:
+            start = time.perf_counter()
+            try:
+                for result in self.call(job.method, *job.args, session=job.session):
+                    job.reply("result", result)
+            except Exception as e:
+                job.reply("error", str(e))
+            job.reply("end", None)
+
+            busy = time.perf_counter() - start
+            with self.condition:
+                if (usage := self.usage.get(job.session)) is not None:
+                    usage.requests += 1
+                    usage.busy += busy
+                    usage.served += busy
+                    usage.wait += start - job.submitted
+            tracing.metrics.observe("model_server_wait_seconds", start - job.submitted, model=self.name, session=job.session)
+            tracing.metrics.observe("model_server_busy_seconds", busy, model=self.name, session=job.session)
+
+    def utilization(self) -> dict[str, dict[str, float]]:
+        now = time.perf_counter()
+        with self.condition:
+            return {
+                session: {
+                    "requests": usage.requests,
+                    "busy": usage.busy,
+                    "wait": usage.wait / usage.requests if usage.requests else 0.0,
+                    "utilization": usage.busy / (now - usage.opened) if now > usage.opened else 0.0,
+                    "queued": sum(job.session == session for job in self.jobs),
+                }
+                for session, usage in self.usage.items()
+            }
+
+
+def format_utilization(utilization: dict[str, dict[str, dict[str, float]]]) -> str:
+    lines = [f"{'session':<16} {'model':<12} {'calls':>6} {'busy (s)':>9} {'utilization':>12} {'mean wait (s)':>14} {'queued':>7}"]
+    for session, models in utilization.items():
+        for model, usage in models.items():
+            lines.append(
+                f"{session:<16} {model:<12} {usage['requests']:>6} {usage['busy']:>9.2f} {usage['utilization']:>12.1%}"
+                f" {usage['wait']:>14.3f} {usage['queued']:>7}"
+            )
+    return "\n".join(lines)
+
+
+class Connected:
+    # a client connection, the schedulers of several models answer on it
+    def __init__(self, name: str, connection: Connection) -> None:
+        self.name = name
+        self.connection = connection
+        self.lock = threading.Lock()
+
+    def send(self, call_id: int, kind: str, payload: Any) -> None:
+        with self.lock:
+            try:
+                self.connection.send((call_id, kind, payload))
+            except OSError:
+                # the client is gone, its calls are dropped when its connection is closed
+                pass
+
+
+class ModelServer:
+    def __init__(self, address: str, registry: ModelRegistry, authkey: bytes | None = None) -> None:
+        self.address = address
+        self.registry = registry
+        self.authkey = authkey
+        self.schedulers = {name: FairScheduler(name, model.call) for name, model in registry.models.items()}
+        self.sessions: dict[str, Connected] = {}
+        self.listener: Listener | None = None
+        self.thread: threading.Thread | None = None
+        self.lock = threading.Lock()
+
+    def start(self) -> None:
+        self.registry.start()
+        for scheduler in self.schedulers.values():
+            scheduler.start()
+        # a socket left by a server that did not stop cleanly is removed, a live one is not
+        if os.path.exists(self.address):
+            with socket.socket(socket.AF_UNIX) as probe:
+                try:
+                    probe.connect(self.address)
+                except ConnectionRefusedError:
+                    os.unlink(self.address)
+        # only local clients, the socket file is created with the permissions of the user
+        self.listener = Listener(self.address, family="AF_UNIX", authkey=self.authkey)
+        self.thread = threading.Thread(target=self.accept, name="model_server", daemon=True)
+        self.thread.start()
+        tqdm.tqdm.write(f"[model_server] listening on {self.address}")
+
+    def stop(self) -> None:
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+        for session in list(self.sessions.values()):
+            session.connection.close()
+        for scheduler in self.schedulers.values():
+            scheduler.stop()
+        self.registry.stop()
+
+    def accept(self) -> None:
+        while self.listener is not None:
+            try:
+                connection = self.listener.accept()
+            except OSError:
+                # the listener was closed
+                return
+            except Exception as e:
+                tqdm.tqdm.write(f"[model_server] connection refused: {e}")
+                continue
+            threading.Thread(target=self.serve, args=(connection,), name="model_server_session", daemon=True).start()
+
+    def open(self, connection: Connection) -> Connected | None:
+        kind, name, options = connection.recv()
+        with self.lock:
+            if kind != "open" or name in self.sessions:
+                connection.send((-1, "error", f"session {name!r} is already open"))
+                return None
+            self.sessions[name] = session = Connected(name, connection)
+
+        # every model gets a session, with the arguments given for it if any
+        self.registry.wait()
+        for model, instance in self.registry.models.items():
+            instance.open_session(name, **options.get(model, {}))
+            self.schedulers[model].open(name)
+        session.send(-1, "ready", list(self.registry.models))
+        tqdm.tqdm.write(f"[model_server] session {name!r} opened")
+        return session
+
+    def close(self, session: Connected) -> None:
+        for model, instance in self.registry.models.items():
+            self.schedulers[model].close(session.name)
+            instance.close_session(session.name)
+        with self.lock:
+            del self.sessions[session.name]
+        tqdm.tqdm.write(f"[model_server] session {session.name!r} closed")
+
+    def serve(self, connection: Connection) -> None:
+        try:
+            session = self.open(connection)
+        except (EOFError, OSError, ValueError) as e:
+            tqdm.tqdm.write(f"[model_server] session not opened: {e}")
+            session = None
+        if session is None:
+            connection.close()
+            return
+
+        try:
+            while True:
+                match connection.recv():
+                    case ("call", call_id, model, method, args, priority, trace) if model in self.schedulers:
+                        self.schedulers[model].submit(Job(session.name, priority, method, args, trace, functools.partial(session.send, call_id)))
+                    case ("call", call_id, model, *_):
+                        session.send(call_id, "error", f"unknown model {model!r}")
+                        session.send(call_id, "end", None)
+                    case ("control", model, method, args) if model in self.registry.models:
+                        self.registry[model].method(method, session=session.name)(*args)
+                    case ("report",):
+                        session.send(-1, "report", self.utilization(session.name))
+                    case message:
+                        tqdm.tqdm.write(f"[model_server] unexpected message from {session.name!r}: {message!r}")
+        except (EOFError, OSError):
+            pass
+        finally:
+            connection.close()
+            self.close(session)
+
+    def utilization(self, session: str | None = None) -> dict[str, dict[str, dict[str, float]]]:
+        utilization: dict[str, dict[str, dict[str, float]]] = {}
+        for model, scheduler in self.schedulers.items():
+            for name, usage in scheduler.utilization().items():
+                if session is None or name == session:
+                    utilization.setdefault(name, {})[model] = usage
+        return utilization
+
+    def report(self) -> str:
+        return format_utilization(self.utilization())
+
+
+class RemoteModel:
+    # a model of the server seen from a session, used like a ProcessModule
+    def __init__(self, client: "ModelClient", name: str) -> None:
+        self.client = client
+        self.name = name
+
+    def transform(self, method: str, priority: int = 0) -> Transform:
+        return functools.partial(self.client.call, self.name, method, priority=priority)
+
+    def batch_transform(self, method: str, priority: int = 0) -> BatchTransform:
+        return functools.partial(self.client.call, self.name, method, priority=priority)
+
+    def method(self, method: str) -> Callable[..., None]:
+        def call(*args: Any) -> None:
+            self.client.send(("control", self.name, method, args))
+
+        return call
+
+
+class ModelClient(Module):
+    # the models of a pipeline served by a ModelServer, used like a ModelRegistry, `options` holds the session arguments of each model
+    def __init__(
+        self,
+        address: str,
+        session: str,
+        options: dict[str, dict[str, Any]] | None = None,
+        authkey: bytes | None = None,
+        connect_timeout: float = 60.0,
+    ) -> None:
+        Module.__init__(self, name=session)
+        self.address = address
+        self.options = options or {}
+        self.authkey = authkey
+        self.connect_timeout = connect_timeout
+        self.connection: Connection | None = None
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.models: list[str] = []
+        self.call_counter = count()
+        self.pending: dict[int, queue.SimpleQueue] = {}
+        self.reports: queue.SimpleQueue = queue.SimpleQueue()
+
+    def __getitem__(self, name: str) -> RemoteModel:
+        return RemoteModel(self, name)
+
+    def start(self) -> None:
+        # the server may still be starting
+        deadline = time.monotonic() + self.connect_timeout
+        while self.connection is None:
+            try:
+                self.connection = Client(self.address, family="AF_UNIX", authkey=self.authkey)
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        self.send(("open", self.name, self.options))
+        Module.start(self)
+
+    def stop(self) -> None:
+        Module.stop(self)
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def wait(self, timeout: float | None = None) -> bool:
+        return self.ready.wait(timeout)
+
+    def send(self, message: tuple) -> None:
+        with self.lock:
+            self.connection.send(message)
+
+    def run(self) -> None:
+        # relays the answers of the server to the calls waiting for them
+        while self.is_running.is_set():
+            try:
+                if not self.connection.poll(0.1):
+                    continue
+                call_id, kind, payload = self.connection.recv()
+            except (EOFError, OSError):
+                tqdm.tqdm.write(f"[{self.name}] connection to the model server lost")
+                for results in list(self.pending.values()):
+                    results.put(("error", "connection to the model server lost"))
+                return
+
+            match kind:
+                case "ready":
+                    self.models = payload
+                    tqdm.tqdm.write(f"[{self.name}] session ready with {', '.join(payload)}")
+                    self.ready.set()
+                case "report":
+                    self.reports.put(payload)
+                case "error" if call_id == -1:
+                    tqdm.tqdm.write(f"[{self.name}] {payload}")
+                case _ if call_id in self.pending:
+                    self.pending[call_id].put((kind, payload))
+
+    def call(self, model: str, method: str, *args: Any, priority: int = 0) -> Iterator[tuple]:
+        self.ready.wait()
+        call_id = next(self.call_counter)
+        results: queue.SimpleQueue = queue.SimpleQueue()
+        self.pending[call_id] = results
+        try:
+            self.send(("call", call_id, model, method, args, priority, tracing.current()))
+            while True:
+                kind, payload = results.get()
+                match kind:
+                    case "result":
+                        yield payload
+                    case "error":
+                        raise RuntimeError(payload)
+                    case _:
+                        return
+        finally:
+            del self.pending[call_id]
+
+    def utilization(self, timeout: float = 5.0) -> dict[str, dict[str, dict[str, float]]]:
+        self.send(("report",))
+        return self.reports.get(timeout=timeout)
+
+    def report(self) -> str:
+        return format_utilization(self.utilization())
@@ -1,7 +1,9 @@
 import abc
+import os
 import threading
 
 import tqdm
+from messaging import Sink
 
 
 class Module(abc.ABC):
@@ -9,6 +11,8 @@ class Module(abc.ABC):
         self.name = name
         self.thread: threading.Thread | None = None
         self.is_running = threading.Event()
+        # cores the thread of the module is pinned to, all those of the process if None
+        self.thread_affinity: list[int] | None = None
 
     @abc.abstractmethod
     def run(self) -> None:
@@ -16,14 +20,27 @@ class Module(abc.ABC):
 
     def start(self) -> None:
         if not self.is_running.is_set():
+            if isinstance(self, Sink):
+                self.sink_queue.open()
             self.is_running.set()
-            self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+            self.thread = threading.Thread(target=self.pinned_run, name=self.name, daemon=True)
             self.thread.start()
             tqdm.tqdm.write(f"[{self.name}] started.")
 
+    def pinned_run(self) -> None:
+        if self.thread_affinity:
+            os.sched_setaffinity(threading.get_native_id(), self.thread_affinity)
+        self.run()
+
+    def unblock(self) -> None:
+        # a module waiting for a message is woken up to see that it has to stop, those waiting on something else extend this
+        if isinstance(self, Sink):
+            self.sink_queue.close()
+
     def stop(self) -> None:
         if self.is_running.is_set() and self.thread:
             self.is_running.clear()
+            self.unblock()
             self.thread.join()
             self.thread = None
             tqdm.tqdm.write(f"[{self.name}] stopped.")
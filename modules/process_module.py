@@ -0,0 +1,338 @@
+import functools
+import multiprocessing as mp
+import queue
+import sys
+import threading
+import time
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass
+from itertools import count
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any
+
+import numpy as np
+import psutil
+import tqdm
+import tracing
+from messaging import BatchTransform, Transform
+from modules.module import Module
+
+
+@dataclass(frozen=True)
+class SharedArray:
+    name: str
+    shape: tuple[int, ...]
+    dtype: str
+
+
+# held while a segment is created or attached, see `attach`
+TRACKER_LOCK = threading.Lock()
+
+
+def attach(name: str) -> shared_memory.SharedMemory:
+    # the segment belongs to its creator, which registered it with the resource tracker, before Python 3.13 attaching registers
+    # it again for this process, whose tracker then warns about a leak and unlinks it a second time if it is not the creator's,
+    # and unregistering it instead would drop the registration of the creator when the tracker is shared with a spawned child
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    with TRACKER_LOCK:
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+class SharedMemoryTransport:
+    # numpy arrays are written once into shared memory and only their descriptor goes through the pipe,
+    # the sender owns the segment until the receiver has copied it out and asked for its release
+    def __init__(self) -> None:
+        self.exported: dict[str, shared_memory.SharedMemory] = {}
+        self.lock = threading.Lock()
+
+    def share(self, value: Any) -> Any:
+        match value:
+            case np.ndarray() if value.nbytes > 0 and value.dtype != object:
+                with TRACKER_LOCK:
+                    segment = shared_memory.SharedMemory(create=True, size=value.nbytes)
+                np.ndarray(value.shape, dtype=value.dtype, buffer=segment.buf)[...] = value
+                with self.lock:
+                    self.exported[segment.name] = segment
+                return SharedArray(segment.name, value.shape, value.dtype.str)
+            case tuple():
+                return tuple(self.share(item) for item in value)
+            case list():
+                return [self.share(item) for item in value]
+            case dict():
+                return {key: self.share(item) for key, item in value.items()}
+            case _:
+                return value
+
+    def unshare(self, value: Any, names: list[str]) -> Any:
+        match value:
+            case SharedArray():
+                # the segment belongs to the sender, it is only closed here and unlinked by the sender on release
+                segment = attach(value.name)
+                array = np.ndarray(value.shape, dtype=np.dtype(value.dtype), buffer=segment.buf).copy()
+                segment.close()
+                names.append(value.name)
+                return array
+            case tuple():
+                return tuple(self.unshare(item, names) for item in value)
+            case list():
+                return [self.unshare(item, names) for item in value]
+            case dict():
+                return {key: self.unshare(item, names) for key, item in value.items()}
+            case _:
+                return value
+
+    def release(self, names: list[str]) -> None:
+        for name in names:
+            with self.lock:
+                segment = self.exported.pop(name, None)
+            if segment is not None:
+                segment.close()
+                segment.unlink()
+
+    def release_all(self) -> None:
+        with self.lock:
+            names = list(self.exported)
+        self.release(names)
+
+
+class ForwardingExporter(tracing.Exporter):
+    # metrics observed in the process are recorded by the exporters of the parent
+    def __init__(self, responses: mp.Queue) -> None:
+        self.responses = responses
+
+    def record(self, name: str, labels: tracing.Labels, value: float, trace_id: int | None) -> None:
+        self.responses.put((-1, "metric", (name, labels, value, trace_id)))
+
+
+def serve_controls(instance: Any, sessions: dict[str, Any], controls: mp.Queue, transport: SharedMemoryTransport) -> None:
+    while (control := controls.get()) is not None:
+        session, method, args = control
+        try:
+            if method == "release":
+                transport.release(*args)
+            else:
+                getattr(instance if session is None else sessions[session], method)(*args)
+        except Exception as e:
+            tqdm.tqdm.write(f"[{method}] error: {e}")
+
+
+def serve(
+    name: str,
+    factory: Callable[[], Any],
+    warmup: str | None,
+    cpu_affinity: list[int] | None,
+    num_threads: int | None,
+    num_interop_threads: int | None,
+    requests: mp.Queue,
+    responses: mp.Queue,
+    controls: mp.Queue,
+) -> None:
+    if cpu_affinity:
+        psutil.Process().cpu_affinity(cpu_affinity)
+    if num_threads or num_interop_threads:
+        import torch
+
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        if num_interop_threads:
+            torch.set_num_interop_threads(num_interop_threads)
+
+    transport = SharedMemoryTransport()
+    tracing.metrics.add_exporter(ForwardingExporter(responses))
+    started = time.time()
+    instance = factory()
+    loaded = time.time()
+    # a representative inference, so that compilation and first-call allocations are not paid by the first request
+    if warmup is not None and hasattr(instance, warmup):
+        try:
+            getattr(instance, warmup)()
+        except Exception as e:
+            tqdm.tqdm.write(f"[{name}] warm-up error: {e}")
+    # a session has its own state (history, voice, streaming buffers) and shares the weights of `instance`, built by its `session` method,
+    # an instance without one is shared as is
+    sessions: dict[str, Any] = {}
+    control_thread = threading.Thread(target=serve_controls, args=(instance, sessions, controls, transport), name=f"{name}_controls", daemon=True)
+    control_thread.start()
+    responses.put((-1, "ready", (started, loaded, time.time())))
+
+    while (request := requests.get()) is not None:
+        call_id, session, method, args, trace = request
+        names: list[str] = []
+        args = transport.unshare(args, names)
+        if names:
+            responses.put((-1, "release", names))
+        try:
+            match method:
+                case "open_session":
+                    sessions[session] = instance.session(**args[0]) if hasattr(instance, "session") else instance
+                case "close_session":
+                    closed = sessions.pop(session, None)
+                    if closed is not None and closed is not instance and hasattr(closed, "close"):
+                        closed.close()
+                case _:
+                    with tracing.use(trace):
+                        for result in getattr(instance if session is None else sessions[session], method)(*args):
+                            responses.put((call_id, "result", transport.share(result)))
+        except Exception as e:
+            responses.put((call_id, "error", str(e)))
+        responses.put((call_id, "end", None))
+
+    controls.put(None)
+    control_thread.join()
+    # a clean shutdown lets the instance and its sessions save what they have to
+    for closing in {id(value): value for value in [instance, *sessions.values()]}.values():
+        if hasattr(closing, "close"):
+            try:
+                closing.close()
+            except Exception as e:
+                tqdm.tqdm.write(f"[{name}] close error: {e}")
+    transport.release_all()
+
+
+class ProcessModule(Module):
+    # hosts an object built by `factory` in its own process, with its own CPU affinity and torch thread budget,
+    # its methods are exposed as transforms so that BasicProxy and BasicBroker use it like the object itself
+    def __init__(
+        self,
+        name: str,
+        factory: Callable[[], Any],
+        cpu_affinity: list[int] | None = None,
+        num_threads: int | None = None,
+        num_interop_threads: int | None = None,
+        warmup: str | None = "warmup",
+    ) -> None:
+        Module.__init__(self, name=name)
+        self.factory = factory
+        self.warmup = warmup
+        self.cpu_affinity = cpu_affinity
+        self.num_threads = num_threads
+        self.num_interop_threads = num_interop_threads
+
+        self.context = mp.get_context("spawn")
+        self.requests: mp.Queue = self.context.Queue()
+        self.responses: mp.Queue = self.context.Queue()
+        self.controls: mp.Queue = self.context.Queue()
+        self.process: mp.Process | None = None
+        self.transport = SharedMemoryTransport()
+        self.ready = threading.Event()
+        # wall clock times of the start, of the process start, of the end of the loading and of the end of the warm-up
+        self.timings: tuple[float, float, float, float] | None = None
+        self.start_time = 0.0
+        self.call_counter = count()
+        self.pending: dict[int, queue.SimpleQueue] = {}
+
+    def start(self) -> None:
+        if self.process is None:
+            self.start_time = time.time()
+            self.process = self.context.Process(
+                target=serve,
+                args=(
+                    self.name,
+                    self.factory,
+                    self.warmup,
+                    self.cpu_affinity,
+                    self.num_threads,
+                    self.num_interop_threads,
+                    self.requests,
+                    self.responses,
+                    self.controls,
+                ),
+                name=self.name,
+                daemon=True,
+            )
+            self.process.start()
+        Module.start(self)
+
+    def stop(self) -> None:
+        if self.process is not None:
+            self.requests.put(None)
+            self.process.join(timeout=10)
+            if self.process.is_alive():
+                self.process.terminate()
+            self.process = None
+        Module.stop(self)
+        self.transport.release_all()
+
+    def unblock(self) -> None:
+        self.responses.put((-1, "stop", None))
+
+    def run(self) -> None:
+        # relays the responses of the process to the calls waiting for them
+        while self.is_running.is_set():
+            call_id, kind, payload = self.responses.get()
+            match kind:
+                case "stop":
+                    continue
+                case "ready":
+                    self.timings = (self.start_time, *payload)
+                    tqdm.tqdm.write(f"[{self.name}] ready in {payload[2] - self.start_time:.1f}s.")
+                    self.ready.set()
+                case "release":
+                    self.transport.release(payload)
+                case "metric":
+                    tracing.metrics.record(*payload)
+                case _ if call_id in self.pending:
+                    self.pending[call_id].put((kind, payload))
+                case "result":
+                    # the caller gave up on this call, the shared arrays still have to be released
+                    self.discard(payload)
+
+    def discard(self, payload: tuple) -> None:
+        names: list[str] = []
+        self.transport.unshare(payload, names)
+        if names:
+            self.controls.put((None, "release", (names,)))
+
+    def call(self, method: str, *args: Any, session: str | None = None) -> Iterator[tuple]:
+        self.ready.wait()
+        call_id = next(self.call_counter)
+        results: queue.SimpleQueue = queue.SimpleQueue()
+        self.pending[call_id] = results
+        try:
+            self.requests.put((call_id, session, method, self.transport.share(args), tracing.current()))
+            while True:
+                kind, payload = results.get()
+                match kind:
+                    case "result":
+                        names: list[str] = []
+                        result = self.transport.unshare(payload, names)
+                        if names:
+                            self.controls.put((None, "release", (names,)))
+                        yield result
+                    case "error":
+                        raise RuntimeError(payload)
+                    case _:
+                        return
+        finally:
+            del self.pending[call_id]
+            while not results.empty():
+                kind, payload = results.get()
+                if kind == "result":
+                    self.discard(payload)
+
+    def transform(self, method: str, session: str | None = None) -> Transform:
+        return functools.partial(self.call, method, session=session)
+
+    def batch_transform(self, method: str, session: str | None = None) -> BatchTransform:
+        return functools.partial(self.call, method, session=session)
+
+    def method(self, method: str, session: str | None = None) -> Callable[..., None]:
+        # fire and forget, the call is made by a separate thread of the process so that it can reach a running transform
+        def call(*args: Any) -> None:
+            self.controls.put((session, method, args))
+
+        return call
+
+    def open_session(self, session: str, **kwargs: Any) -> None:
+        for _ in self.call("open_session", kwargs, session=session):
+            pass
+
+    def close_session(self, session: str) -> None:
+        for _ in self.call("close_session", session=session):
+            pass
@@ -0,0 +1,136 @@
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+import tqdm
+import tracing
+from messaging import MessageType, Sink, Source
+from modules.audio_utils import read_wav, resample, write_wav
+from modules.module import Module
+
+
+class FileInputDevice(Module, Source):
+    # replays wav files as utterances, paced like a speaker (`speed` times faster, or as fast as possible if 0),
+    # the messages are the ones InputDevice would send so that the rest of the pipeline can not tell the difference
+    def __init__(
+        self,
+        name: str,
+        paths: list[str],
+        samplerate: int = 16000,
+        speed: float = 1.0,
+        endpoint_delay: float = 1.0,
+        gap_duration: float = 2.0,
+        streaming: bool = False,
+        stream_chunk_duration: float = 0.5,
+        wait_for_reply: bool = True,
+        reply_timeout: float = 60.0,
+    ) -> None:
+        Module.__init__(self, name=name)
+        Source.__init__(self, name=name)
+        self.utterances = [read_wav(path, samplerate)[0] for path in paths]
+        self.samplerate = samplerate
+        self.speed = speed
+        self.endpoint_delay = endpoint_delay
+        self.gap_duration = gap_duration
+        self.streaming = streaming
+        self.stream_chunk = int(stream_chunk_duration * samplerate)
+        # the next utterance is only played once the previous one got an answer, like a turn-based conversation
+        self.wait_for_reply = wait_for_reply
+        self.reply_timeout = reply_timeout
+        self.replied = threading.Event()
+        self.done = threading.Event()
+
+    def wait(self, duration: float) -> None:
+        if self.speed > 0:
+            time.sleep(duration / self.speed)
+
+    def play(self, audio: np.ndarray) -> None:
+        trace = tracing.Trace(speaker=self.name)
+        with tracing.use(trace):
+            if self.streaming:
+                for start in range(0, len(audio), self.stream_chunk):
+                    chunk = audio[start : start + self.stream_chunk]
+                    self.wait(len(chunk) / self.samplerate)
+                    self.send_message(MessageType.AUDIO, (chunk, self.samplerate, False, self.name))
+                trace.end_of_speech = time.time()
+                self.wait(self.endpoint_delay)
+                self.send_message(MessageType.AUDIO, (np.zeros(0, dtype=np.float32), self.samplerate, True, self.name))
+            else:
+                self.wait(len(audio) / self.samplerate)
+                trace.end_of_speech = time.time()
+                self.wait(self.endpoint_delay)
+                self.send_message(MessageType.AUDIO, (audio, self.samplerate))
+
+    def run(self) -> None:
+        for i, audio in enumerate(self.utterances):
+            if not self.is_running.is_set():
+                break
+
+            self.replied.clear()
+            tqdm.tqdm.write(f"[{self.name}] utterance {i + 1}/{len(self.utterances)} ({len(audio) / self.samplerate:.2f}s)")
+            self.play(audio)
+            if self.wait_for_reply and not self.replied.wait(self.reply_timeout):
+                tqdm.tqdm.write(f"[{self.name}] no reply to utterance {i + 1}")
+            self.wait(self.gap_duration)
+
+        self.done.set()
+
+
+class CaptureSink(Module, Sink):
+    # stands in for OutputDevice, playback is simulated with a clock instead of a sound card and the audio can be kept
+    def __init__(
+        self, name: str, samplerate: int = 24000, speed: float = 1.0, capture: bool = False, on_first_audio: threading.Event | None = None
+    ) -> None:
+        Module.__init__(self, name=name)
+        Sink.__init__(self, name=name)
+        self.samplerate = samplerate
+        self.speed = speed
+        self.capture = capture
+        self.on_first_audio = on_first_audio
+        self.captured: list[np.ndarray] = []
+        self.texts: list[str] = []
+        self.played_until = 0.0
+        self.audio_duration = 0.0
+        # replies by speaker, an utterance counts once however many segments its reply has
+        self.replies: dict[str | None, int] = defaultdict(int)
+        self.replied_traces: set[int] = set()
+        self.speakers: dict[str, threading.Event] = {}
+
+    def register_speaker(self, device: FileInputDevice) -> None:
+        # the device only waits for the replies to its own utterances
+        self.speakers[device.name] = device.replied
+
+    def save(self, path: str) -> None:
+        write_wav(path, np.concatenate(self.captured) if self.captured else np.zeros(0, dtype=np.float32), self.samplerate)
+
+    def run(self) -> None:
+        while self.is_running.is_set():
+            message = self.get_message()
+            if message is None:
+                continue
+
+            with tracing.span(self.name, message.trace):
+                match message.type:
+                    case MessageType.TEXT:
+                        self.texts.append(message.content)
+                    case MessageType.AUDIO:
+                        now = time.time()
+                        duration = len(message.content[0]) / message.content[1]
+                        trace = message.trace
+                        if trace is not None and trace.end_of_speech is not None and trace.id not in self.replied_traces:
+                            # the reply to a new utterance starts right away, what was left of the previous one is cut like on barge-in
+                            self.played_until = now
+                            trace.first_audio = now
+                            tracing.metrics.observe("end_of_speech_to_first_audio_seconds", trace.first_audio - trace.end_of_speech, module=self.name)
+                            self.replied_traces.add(trace.id)
+                            self.replies[trace.speaker] += 1
+                            if self.on_first_audio is not None:
+                                self.on_first_audio.set()
+                            if trace.speaker in self.speakers:
+                                self.speakers[trace.speaker].set()
+
+                        self.played_until = max(now, self.played_until) + (duration / self.speed if self.speed > 0 else 0)
+                        self.audio_duration += duration
+                        if self.capture:
+                            self.captured.append(resample(np.asarray(message.content[0], dtype=np.float32).ravel(), message.content[1], self.samplerate))
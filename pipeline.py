@@ -0,0 +1,246 @@
+import functools
+import importlib
+import os
+import re
+import tomllib
+from collections.abc import Callable
+from typing import Any
+
+import psutil
+from messaging import MessageType, Producer, QueuePolicy, Sink, Source
+from modules.basic_modules import BasicBroker, BasicProxy, BasicSink, BatchProxy, ConcurrentBroker
+from modules.model_registry import ModelRegistry
+from modules.model_server import ModelClient, RemoteModel
+from modules.module import Module
+
+# a pipeline file describes the model processes, the nodes and how they are connected, see pipeline.toml:
+# - [process]: `cpu_affinity` and `nice` of the main process, where the nodes run
+# - [models.<name>]: `factory` ("module:attribute") built with `args` in its own process, with `cpu_affinity`, `num_threads`,
+#   `num_interop_threads` and `warmup`
+# - [nodes.<name>]: `type` ("proxy", "batch_proxy", "broker", "concurrent_broker", "sink" or "module:attribute" built with
+#   `args`), `transform` ("<model>.<method>" or "module:attribute"), `priority`, `cpu_affinity` of its thread, `inputs` as
+#   [source, message type] pairs, `routes` of a broker as {from, to, transform} and for a concurrent broker `workers`,
+#   `max_in_flight`, `ordered` and `blocking`, `preempts` of a broker called when a message arrives, `interrupts` of an input device, and
+#   `queue_capacity` and `queue_policy` of a sink
+# values of `args` may be references: "@<model>.<method>" is a call to a model, "@<node>" a node, "@<node>.<attribute>" one of
+# its attributes, {file = path} the content of a file and {call = reference, args = [...]} a call with bound arguments
+# with a [server] `session`, the models are those of the model server listening on [server] `address` (see serve.py) with an optional
+# `authkey`, shared with other pipelines: [models.<name>] then only holds the `session` arguments of the model (system prompt, voice, ...)
+
+SUB_PRODUCER = re.compile(r"(\w+)\[(\w+)\]")
+
+
+def load_config(path: str) -> dict[str, Any]:
+    with open(path, "rb") as f:
+        if path.endswith((".yaml", ".yml")):
+            import yaml
+
+            return yaml.safe_load(f)
+        return tomllib.load(f)
+
+
+def import_attribute(path: str) -> Any:
+    module, _, attribute = path.partition(":")
+    return getattr(importlib.import_module(module), attribute)
+
+
+def format_cores(cores: list[int] | None) -> str:
+    return ",".join(map(str, cores)) if cores else "any"
+
+
+class Pipeline:
+    def __init__(self, config: dict[str, Any]) -> None:
+        self.config = config
+        self.process = config.get("process", {})
+        self.model_configs: dict[str, dict[str, Any]] = config.get("models", {})
+        self.node_configs: dict[str, dict[str, Any]] = config.get("nodes", {})
+        self.server = config.get("server", {})
+        self.registry: ModelRegistry | ModelClient = (
+            ModelClient(self.server["address"], self.server["session"], authkey=self.server["authkey"].encode() if "authkey" in self.server else None)
+            if "session" in self.server
+            else ModelRegistry(compile_cache_dir=self.process.get("compile_cache_dir", "cache/inductor"))
+        )
+        self.nodes: dict[str, Module] = {}
+        self.validate()
+
+    @classmethod
+    def from_file(cls, path: str) -> "Pipeline":
+        return cls(load_config(path))
+
+    def validate(self) -> None:
+        names = set(self.model_configs) | set(self.node_configs)
+        for name, node in self.node_configs.items():
+            for source, type in node.get("inputs", []):
+                if source not in self.node_configs:
+                    raise ValueError(f"[{name}] unknown input {source!r}")
+                if type not in MessageType.__members__:
+                    raise ValueError(f"[{name}] unknown message type {type!r}")
+            for route in node.get("routes", []):
+                source = SUB_PRODUCER.fullmatch(route["from"])
+                for reference in (source.group(1) if source else route["from"], route["to"]):
+                    if reference not in self.node_configs:
+                        raise ValueError(f"[{name}] unknown route end {reference!r}")
+            for transform in [node.get("transform"), *(route["transform"] for route in node.get("routes", []))]:
+                if transform is not None and ":" not in transform and transform.split(".")[0] not in self.model_configs:
+                    raise ValueError(f"[{name}] unknown model in transform {transform!r}")
+            if node.get("queue_policy", "block").upper() not in QueuePolicy.__members__:
+                raise ValueError(f"[{name}] unknown queue policy {node['queue_policy']!r}")
+            for key in ("interrupts", "preempts"):
+                for reference in node.get(key, []):
+                    if isinstance(reference, str) and reference.lstrip("@").split(".")[0] not in names:
+                        raise ValueError(f"[{name}] unknown {key[:-1]} {reference!r}")
+
+    def resolve(self, value: Any) -> Any:
+        match value:
+            case str() if value.startswith("@"):
+                name, _, attribute = value[1:].partition(".")
+                if name in self.model_configs:
+                    return self.registry[name].method(attribute)
+                return getattr(self.nodes[name], attribute) if attribute else self.nodes[name]
+            case {"file": path}:
+                with open(path, encoding="utf-8") as f:
+                    return f.read()
+            case {"call": reference, **rest}:
+                return functools.partial(self.resolve(reference), *(self.resolve(arg) for arg in rest.get("args", [])))
+            case list():
+                return [self.resolve(item) for item in value]
+            case dict():
+                return {key: self.resolve(item) for key, item in value.items()}
+            case _:
+                return value
+
+    def transform(self, reference: str, batch: bool = False, priority: int = 0) -> Callable:
+        if ":" in reference:
+            return import_attribute(reference)
+        model, method = reference.split(".", 1)
+        # the model server schedules the calls of its sessions by the priority of the producer they come from
+        options = {"priority": priority} if isinstance(self.registry[model], RemoteModel) else {}
+        return self.registry[model].batch_transform(method, **options) if batch else self.registry[model].transform(method, **options)
+
+    def producer(self, reference: str) -> Producer:
+        # "proxy[source]" is the producer of a per-producer batch proxy for the messages that came from `source`
+        if match := SUB_PRODUCER.fullmatch(reference):
+            return self.nodes[match.group(1)].producer_for(self.nodes[match.group(2)])
+        return self.nodes[reference]
+
+    def build_models(self) -> None:
+        if isinstance(self.registry, ModelClient):
+            self.registry.options = {name: self.resolve(model.get("session", {})) for name, model in self.model_configs.items()}
+            return
+
+        for name, model in self.model_configs.items():
+            self.registry.register(
+                name,
+                functools.partial(import_attribute(model["factory"]), **self.resolve(model.get("args", {}))),
+                cpu_affinity=model.get("cpu_affinity"),
+                num_threads=model.get("num_threads"),
+                num_interop_threads=model.get("num_interop_threads"),
+                warmup=model.get("warmup", "warmup"),
+            )
+
+    def build_node(self, name: str, node: dict[str, Any]) -> Module:
+        kind = node.get("type", "proxy")
+        priority = node.get("priority", 0)
+        args = self.resolve(node.get("args", {}))
+        match kind:
+            case "proxy":
+                return BasicProxy(name, self.transform(node["transform"], priority=priority), priority=priority, **args)
+            case "batch_proxy":
+                return BatchProxy(name, self.transform(node["transform"], batch=True, priority=priority), priority=priority, **args)
+            case "broker":
+                return BasicBroker(name, priority=priority, **args)
+            case "concurrent_broker":
+                return ConcurrentBroker(name, priority=priority, **args)
+            case "sink":
+                return BasicSink(name, self.transform(node["transform"]), **args)
+            case _:
+                instance = import_attribute(kind)(name=name, **args)
+                if isinstance(instance, Producer) and "priority" in node:
+                    instance.priority = priority
+                return instance
+
+    def build(self) -> None:
+        self.build_models()
+        # built in order, so that the arguments of a node may refer to the nodes above it
+        for name, node in self.node_configs.items():
+            self.nodes[name] = self.build_node(name, node)
+            self.nodes[name].thread_affinity = node.get("cpu_affinity")
+            if "queue_capacity" in node:
+                self.nodes[name].set_queue_capacity(node["queue_capacity"], QueuePolicy[node.get("queue_policy", "BLOCK").upper()])
+
+        for name, node in self.node_configs.items():
+            instance = self.nodes[name]
+            for source, type in node.get("inputs", []):
+                if not isinstance(instance, Sink) or not isinstance(self.nodes[source], Source):
+                    raise ValueError(f"[{name}] can not receive from [{source}]")
+                self.nodes[source].register_sink(instance, MessageType[type])
+            for route in node.get("routes", []):
+                options = {key: route[key] for key in ("workers", "max_in_flight", "ordered", "blocking") if key in route}
+                producer = self.producer(route["from"])
+                instance.register_route(producer, self.nodes[route["to"]], self.transform(route["transform"], priority=producer.priority), **options)
+            for reference in node.get("interrupts", []):
+                instance.register_interrupt(self.resolve(reference))
+            for reference in node.get("preempts", []):
+                instance.register_preempt(self.resolve(reference))
+
+    def start(self) -> None:
+        # the model processes are spawned first so that they do not inherit the priority of the main process
+        self.registry.start()
+        process = psutil.Process()
+        if "cpu_affinity" in self.process:
+            process.cpu_affinity(self.process["cpu_affinity"])
+        if "nice" in self.process:
+            process.nice(self.process["nice"])
+
+        # downstream first, so that nothing is sent to a node that is not running
+        for node in reversed(self.nodes.values()):
+            node.start()
+
+    def stop(self) -> None:
+        for node in self.nodes.values():
+            node.stop()
+        self.registry.stop()
+
+    def describe(self) -> str:
+        lines = [f"main process: cores {format_cores(self.process.get('cpu_affinity'))}, nice {self.process.get('nice', 0)}"]
+        # the cores of served models are those of the server
+        models = {} if isinstance(self.registry, ModelClient) else self.model_configs
+        if isinstance(self.registry, ModelClient):
+            lines.append(f"session {self.server['session']!r} of the model server at {self.server['address']}:")
+            lines.extend(f"  {name:<20} {model.get('session', {})}" for name, model in self.model_configs.items())
+        else:
+            lines.append("models:")
+        for name, model in models.items():
+            lines.append(
+                f"  {name:<20} {model['factory']:<40} cores {format_cores(model.get('cpu_affinity')):<12}"
+                f" threads {model.get('num_threads', 'default')}/{model.get('num_interop_threads', 'default')}"
+            )
+
+        lines.append("nodes:")
+        for name, node in self.node_configs.items():
+            transform = f" <- {node['transform']}" if "transform" in node else ""
+            cores = format_cores(node.get("cpu_affinity"))
+            queue = f", queue {node['queue_capacity']} {node.get('queue_policy', 'block').lower()}" if "queue_capacity" in node else ""
+            lines.append(f"  {name:<20} {node.get('type', 'proxy')}{transform}, priority {node.get('priority', 0)}, cores {cores}{queue}")
+            for source, type in node.get("inputs", []):
+                lines.append(f"    {source} --{type}--> {name}")
+            for route in node.get("routes", []):
+                options = "".join(f", {key} {route[key]}" for key in ("workers", "max_in_flight", "ordered", "blocking") if key in route)
+                lines.append(f"    {route['from']} --{route['transform']}--> {route['to']}{options}")
+            for reference in node.get("interrupts", []):
+                lines.append(f"    interrupts {reference}")
+            for reference in node.get("preempts", []):
+                lines.append(f"    preempts {reference}")
+
+        # the main process may share the cores of the models, the models should not share theirs
+        owners: dict[int, list[str]] = {}
+        for name, model in models.items():
+            for core in model.get("cpu_affinity") or []:
+                owners.setdefault(core, []).append(name)
+        for core, names in sorted(owners.items()):
+            if len(names) > 1:
+                lines.append(f"warning: core {core} is shared by {', '.join(names)}")
+        available = set(range(os.cpu_count() or 0))
+        if missing := sorted((set(owners) | set(self.process.get("cpu_affinity", []))) - available):
+            lines.append(f"warning: cores {format_cores(missing)} do not exist on this machine")
+        return "\n".join(lines)
@@ -0,0 +1,37 @@
+import argparse
+import time
+
+import tracing
+from modules.model_server import ModelServer
+from pipeline import Pipeline, load_config
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="serve the models of a pipeline file to several pipelines over a Unix socket")
+    parser.add_argument("config", nargs="?", default="pipeline.toml")
+    parser.add_argument("--address", help="path of the socket, [server] address of the file by default")
+    parser.add_argument("--report-interval", type=float, default=60.0, help="seconds between two utilization reports")
+    args = parser.parse_args()
+
+    # the models and the [server] section of the file, its nodes are left to the clients
+    config = load_config(args.config)
+    server_config = config.pop("server", {})
+    pipeline = Pipeline(config)
+    pipeline.build_models()
+    address = args.address or server_config.get("address", "/tmp/assistant_models.sock")
+    server = ModelServer(address, pipeline.registry, authkey=server_config["authkey"].encode() if "authkey" in server_config else None)
+
+    if "prometheus_port" in config.get("metrics", {}):
+        tracing.metrics.add_exporter(tracing.PrometheusExporter(port=config["metrics"]["prometheus_port"]))
+
+    server.start()
+    try:
+        pipeline.registry.wait()
+        print(pipeline.registry.report())
+        while True:
+            time.sleep(args.report_interval)
+            print(server.report())
+    except KeyboardInterrupt:
+        server.stop()
+
+    print("done.")
@@ -0,0 +1,183 @@
+import abc
+import bisect
+import contextvars
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from typing import IO, Any
+
+global_trace_id = count()
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 50.0, 100.0, float("inf"))
+
+
+@dataclass
+class Trace:
+    # follows one utterance through the pipeline, timestamps are wall clock so that they are comparable across processes
+    id: int = field(default_factory=lambda: next(global_trace_id))
+    started: float = field(default_factory=time.time)
+    end_of_speech: float | None = None
+    first_audio: float | None = None
+    # name of the input device the utterance was heard on
+    speaker: str | None = None
+
+
+current_trace: contextvars.ContextVar[Trace | None] = contextvars.ContextVar("current_trace", default=None)
+
+
+def current() -> Trace | None:
+    return current_trace.get()
+
+
+@contextmanager
+def use(trace: Trace | None) -> Iterator[None]:
+    token = current_trace.set(trace)
+    try:
+        yield
+    finally:
+        current_trace.reset(token)
+
+
+@contextmanager
+def span(module: str, trace: Trace | None) -> Iterator[None]:
+    # the transform of a module runs with the trace of its input, so that the messages it sends inherit it
+    start = time.perf_counter()
+    with use(trace):
+        try:
+            yield
+        finally:
+            metrics.observe("module_transform_seconds", time.perf_counter() - start, module=module)
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = BUCKETS, samples: int = 10000) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.samples: deque[float] = deque(maxlen=samples)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.samples.append(value)
+
+    def quantile(self, q: float) -> float:
+        if not self.samples:
+            return float("nan")
+        values = sorted(self.samples)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+
+Labels = tuple[tuple[str, str], ...]
+
+
+class Exporter(abc.ABC):
+    @abc.abstractmethod
+    def record(self, name: str, labels: Labels, value: float, trace_id: int | None) -> None:
+        raise NotImplementedError
+
+
+class InProcessExporter(Exporter):
+    def __init__(self) -> None:
+        self.histograms: dict[tuple[str, Labels], Histogram] = defaultdict(Histogram)
+        self.lock = threading.Lock()
+
+    def record(self, name: str, labels: Labels, value: float, trace_id: int | None) -> None:
+        with self.lock:
+            self.histograms[(name, labels)].observe(value)
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        with self.lock:
+            return {
+                format_series(name, labels): {
+                    "count": histogram.count,
+                    "mean": histogram.sum / histogram.count,
+                    "p50": histogram.quantile(0.5),
+                    "p95": histogram.quantile(0.95),
+                    "p99": histogram.quantile(0.99),
+                }
+                for (name, labels), histogram in sorted(self.histograms.items())
+                if histogram.count
+            }
+
+
+class JsonLinesExporter(Exporter):
+    def __init__(self, path: str) -> None:
+        self.file: IO[str] = open(path, "a", buffering=1)
+        self.lock = threading.Lock()
+
+    def record(self, name: str, labels: Labels, value: float, trace_id: int | None) -> None:
+        line = json.dumps({"time": time.time(), "name": name, "labels": dict(labels), "value": value, "trace_id": trace_id})
+        with self.lock:
+            self.file.write(line + "\n")
+
+
+class PrometheusExporter(InProcessExporter):
+    def __init__(self, port: int = 9464, host: str = "127.0.0.1") -> None:
+        InProcessExporter.__init__(self)
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                body = exporter.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, name="prometheus_exporter", daemon=True).start()
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bucket, bucket_count in zip(histogram.buckets, histogram.counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bucket == float("inf") else repr(bucket)
+                    lines.append(f"{format_series(name + '_bucket', labels + (('le', le),))} {cumulative}")
+                lines.append(f"{format_series(name + '_sum', labels)} {histogram.sum}")
+                lines.append(f"{format_series(name + '_count', labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def format_series(name: str, labels: Labels) -> str:
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self.exporters: list[Exporter] = []
+
+    def add_exporter(self, exporter: Exporter) -> None:
+        self.exporters.append(exporter)
+
+    def remove_exporter(self, exporter: Exporter) -> None:
+        self.exporters.remove(exporter)
+
+    def record(self, name: str, labels: Labels, value: float, trace_id: int | None) -> None:
+        for exporter in self.exporters:
+            exporter.record(name, labels, value, trace_id)
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        if self.exporters:
+            trace = current()
+            self.record(name, tuple(sorted(labels.items())), value, trace.id if trace is not None else None)
+
+
+metrics = Metrics()